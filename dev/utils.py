@@ -1,10 +1,20 @@
 import json
+import queue
+import re
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 from enum import Enum
 from pathlib import Path
 
+import pandas as pd
 import yaml
+from bson import json_util
 from IPython.core.display import HTML, display
 from pymongo.mongo_client import MongoClient
 from tqdm import tqdm
@@ -40,39 +50,145 @@ def build_mongodb_uri(env, with_credentials=True, config=CONFIG):
     return uri
 
 
-def build_mongo_client(env, config=CONFIG):
-    uri = build_mongodb_uri(env, config)
-    return MongoClient(uri)
-
-
-MONGO_CLIENTS = {
-    "production": build_mongo_client("production"),
-    "backup": build_mongo_client("backup"),
-    "local": build_mongo_client("local"),
-}
+def build_mongo_client(
+    env,
+    config=CONFIG,
+    max_pool_size: int | None = None,
+    min_pool_size: int | None = None,
+    compressors: str | None = None,
+):
+    """Creates a new MongoClient for env
+    client options default to config["mongodb"]["client_options"] (if any),
+    e.g. {"maxPoolSize": 20, "compressors": "zstd,snappy"}
+    """
+    uri = build_mongodb_uri(env, config=config)
+    options = dict(config["mongodb"].get("client_options") or {})
+    if max_pool_size is not None:
+        options["maxPoolSize"] = max_pool_size
+    if min_pool_size is not None:
+        options["minPoolSize"] = min_pool_size
+    if compressors is not None:
+        options["compressors"] = compressors
+    return MongoClient(uri, **options)
+
+
+## clients are created on first use, then shared (one connection pool per env)
+MONGO_CLIENTS = dict()
+MONGO_CLIENTS_LOCK = threading.Lock()
+
+
+def get_mongo_client(env, check_health=False, **client_options):
+    """Returns the shared MongoClient for env, creating it on first call
+    client_options (see build_mongo_client) only apply when the client is created.
+    With check_health=True, the client is pinged and re-created if the ping fails.
+    """
+    with MONGO_CLIENTS_LOCK:
+        client = MONGO_CLIENTS.get(env)
+        if client is not None and check_health:
+            if not test_mongo_client(client, print_ok=False):
+                client.close()
+                client = None
+        if client is None:
+            client = build_mongo_client(env, **client_options)
+            MONGO_CLIENTS[env] = client
+        return client
 
 
-def get_mongo_client(env):
-    return MONGO_CLIENTS[env]
+def close_mongo_clients():
+    with MONGO_CLIENTS_LOCK:
+        for client in MONGO_CLIENTS.values():
+            client.close()
+        MONGO_CLIENTS.clear()
 
 
 PATH_MONGO_LOCAL = Path(CONFIG["mongodb"]["path_local"])
 PATH_MONGO_LOCAL_DATA = PATH_MONGO_LOCAL / "data"
 PATH_MONGO_LOCAL_DB = PATH_MONGO_LOCAL_DATA / "db"
 PATH_MONGO_LOCAL_ARCHIVES = PATH_MONGO_LOCAL_DATA / "archives"
+PATH_MONGO_LOCAL_MANIFEST = PATH_MONGO_LOCAL_DATA / "archives_manifest.json"
+PATH_MONGO_RUN_LOG = PATH_MONGO_LOCAL_DATA / "runs.jsonl"
 
 
 ###############
 
 
+### run a function over a list of items in a thread pool
+def run_in_thread_pool(func, items, max_workers=1, display_progress=True):
+    """Calls func(item) for each item, with up to max_workers calls at once.
+    Results are returned in the same order as items.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(func, item): i for (i, item) in enumerate(items)}
+        with tqdm(total=len(items), disable=not display_progress) as pbar:
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                pbar.update(1)
+    return results
+
+
+### dump / restore metrics
+MONGODUMP_DOCS_PATTERN = rb"done dumping .* \((\d+) documents?\)"
+MONGORESTORE_DOCS_PATTERN = rb"(\d+) document\(s\) restored successfully"
+RUN_LOG_LOCK = threading.Lock()
+
+
+def get_archive_size(path_archive):
+    return sum(p.stat().st_size for p in Path(path_archive).rglob("*") if p.is_file())
+
+
+def count_documents_in_logs(stderr, pattern):
+    """Sums the document counts found in mongodump / mongorestore logs"""
+    if not stderr:
+        return None
+    return sum(int(n) for n in re.findall(pattern, stderr))
+
+
+def build_operation_metrics(
+    stage, db_name, started_at, duration, error, nb_bytes=None, nb_docs=None
+):
+    return {
+        "stage": stage,
+        "db_name": db_name,
+        "started_at": started_at.isoformat(),
+        "duration": duration,
+        "nb_bytes": nb_bytes,
+        "nb_docs": nb_docs,
+        "mb_per_s": nb_bytes / 10**6 / duration if nb_bytes and duration else None,
+        "error": error is not None,
+    }
+
+
+def append_run_log(metrics, path_run_log=PATH_MONGO_RUN_LOG):
+    with RUN_LOG_LOCK:
+        with open(path_run_log, "a") as file:
+            file.write(json.dumps(metrics) + "\n")
+
+
+def return_with_metrics(out, metrics, with_metrics=False, path_run_log=None):
+    """Logs the metrics if path_run_log is set, and returns (output, error)
+    or (output, error, metrics) if with_metrics
+    """
+    if path_run_log is not None:
+        append_run_log(metrics, path_run_log)
+    return (*out, metrics) if with_metrics else out
+
+
+def read_run_log(path_run_log=PATH_MONGO_RUN_LOG):
+    return pd.read_json(path_run_log, lines=True)
+
+
 ### test_mongo_client
 def test_mongo_client(mongo_client, print_ok=True):
     try:
         mongo_client.admin.command("ping")
         if print_ok:
             print("Pinged your deployment. You successfully connected to MongoDB!")
+        return True
     except Exception as e:
         print(e)
+        return False
 
 
 def get_mongo_version(mongo_client):
@@ -80,21 +196,13 @@ def get_mongo_version(mongo_client):
 
 
 ### pull database from remote cluster to local
-def dump_database(
-    env,
-    db_name,
-    path_local_archives=PATH_MONGO_LOCAL_ARCHIVES,
-    verbose=False,
-    debug=False,
-    config=CONFIG,
-):
-    """Dumps a database from the remote cluster to the local archive"""
-
+def build_mongodump_command(env, db_name, config=CONFIG):
+    """mongodump command for a database of the remote cluster, without output options"""
     uri = build_mongodb_uri(env=env, with_credentials=False)
     username = config["mongodb"]["username"]
     password = config["mongodb"]["password"]
 
-    command = [
+    return [
         "mongodump",
         "--uri",
         str(uri),
@@ -104,12 +212,38 @@ def dump_database(
         password,
         "--db",
         db_name,
+    ]
+
+
+def dump_database(
+    env,
+    db_name,
+    path_local_archives=PATH_MONGO_LOCAL_ARCHIVES,
+    verbose=False,
+    debug=False,
+    config=CONFIG,
+    num_parallel_collections: int | None = None,
+    exclude_collections: list[str] | None = None,
+    with_metrics=False,
+    path_run_log=None,
+):
+    """Dumps a database from the remote cluster to the local archive
+    with_metrics=True adds a 3rd element to the output: duration, archive
+    bytes, documents and MB/s of the dump (also appended to path_run_log if set)
+    """
+
+    command = build_mongodump_command(env, db_name, config) + [
         "--out",
         str(path_local_archives),
     ]
+    if num_parallel_collections is not None:
+        command += ["--numParallelCollections", str(num_parallel_collections)]
+    for coll_name in exclude_collections or []:
+        command += ["--excludeCollection", coll_name]
 
     if debug:
         print("command: " + " ".join(command))
+    started_at, start = datetime.now(), time.perf_counter()
     try:
         output = subprocess.run(command, capture_output=True, check=True)
         error = None
@@ -119,7 +253,19 @@ def dump_database(
     finally:
         if verbose:
             print(f"- dumping db '{db_name}'" + (error is not None) * " (ERROR)")
-        return (output, error)
+        path_archive = Path(path_local_archives) / db_name
+        metrics = build_operation_metrics(
+            "dump",
+            db_name,
+            started_at,
+            time.perf_counter() - start,
+            error,
+            nb_bytes=get_archive_size(path_archive) if path_archive.exists() else None,
+            nb_docs=count_documents_in_logs(
+                (output or error).stderr, MONGODUMP_DOCS_PATTERN
+            ),
+        )
+        return return_with_metrics((output, error), metrics, with_metrics, path_run_log)
 
 
 def dump_databases(
@@ -129,40 +275,94 @@ def dump_databases(
     verbose=False,
     debug=False,
     config=CONFIG,
+    max_workers: int = 1,
+    num_parallel_collections: int | None = None,
+    with_metrics=False,
+    path_run_log=None,
 ):
+    """Dumps several databases from the remote cluster to the local archive
+    up to max_workers mongodump processes run at the same time
+    outputs are returned in the same order as db_name
+    """
     if isinstance(db_name, str):
         db_name = [db_name]
     if db_name is None:
-        db_name = list_database_names(MONGO_CLIENTS[env])
+        db_name = get_all_database_names(get_mongo_client(env))
+
+    def dump(dbn):
+        return dump_database(
+            env,
+            dbn,
+            path_local_archives,
+            verbose,
+            debug,
+            config,
+            num_parallel_collections=num_parallel_collections,
+            with_metrics=with_metrics,
+            path_run_log=path_run_log,
+        )
 
-    outputs = list()
-    for dbn in tqdm(db_name):
-        out = dump_database(env, dbn, path_local_archives, verbose, debug, config)
-        outputs.append(out)
-    return outputs
+    return run_in_thread_pool(dump, db_name, max_workers=max_workers)
+
+
+def build_mongorestore_options(
+    num_parallel_collections: int | None = None,
+    num_insertion_workers: int | None = None,
+    no_index_restore=False,
+):
+    options = list()
+    if num_parallel_collections is not None:
+        options += ["--numParallelCollections", str(num_parallel_collections)]
+    if num_insertion_workers is not None:
+        options += ["--numInsertionWorkersPerCollection", str(num_insertion_workers)]
+    if no_index_restore:
+        options += ["--noIndexRestore"]
+    return options
 
 
 def restore_database(
     db_name,
     path_local_archives=PATH_MONGO_LOCAL_ARCHIVES,
-    mongo_client_local=MONGO_CLIENTS["local"],
+    mongo_client_local=None,
     verbose=False,
     debug=False,
+    collections: list[str] | None = None,
+    num_parallel_collections: int | None = None,
+    num_insertion_workers: int | None = None,
+    no_index_restore=False,
+    with_metrics=False,
+    path_run_log=None,
 ):
-    """Restores a database on the local MongoDB server"""
+    """Restores a database on the local MongoDB server
+    if collections is given, only these collections are restored
+    with no_index_restore=True, only the data is restored: indexes can be built
+    afterwards with restore_database_indexes
+    with_metrics: see dump_database
+    """
     # first, drop the database if it already exists
     # mongo_client_local.drop_database(db_name)
 
-    command = [
-        "mongorestore",
-        "--drop",
-        "--db",
-        db_name,
-        str(path_local_archives / db_name),
-    ]
+    if collections:
+        ## --db turns into an implicit <db_name>.* filter: select the collections
+        ## with --nsInclude only, from the archives root (<db_name>/<coll>.bson)
+        command = ["mongorestore", "--drop", str(path_local_archives)]
+        for coll_name in collections:
+            command += ["--nsInclude", f"{db_name}.{coll_name}"]
+    else:
+        command = [
+            "mongorestore",
+            "--drop",
+            "--db",
+            db_name,
+            str(path_local_archives / db_name),
+        ]
+    command += build_mongorestore_options(
+        num_parallel_collections, num_insertion_workers, no_index_restore
+    )
 
     if debug:
         print(" ".join(command))
+    started_at, start = datetime.now(), time.perf_counter()
     try:
         output = subprocess.run(command, capture_output=True, check=True)
         error = None
@@ -172,35 +372,142 @@ def restore_database(
     finally:
         if verbose:
             print(f"- restoring db '{db_name}'" + (error is not None) * " (ERROR)")
+        metrics = build_operation_metrics(
+            "restore",
+            db_name,
+            started_at,
+            time.perf_counter() - start,
+            error,
+            nb_bytes=get_archive_size(Path(path_local_archives) / db_name),
+            nb_docs=count_documents_in_logs(
+                (output or error).stderr, MONGORESTORE_DOCS_PATTERN
+            ),
+        )
+        return return_with_metrics((output, error), metrics, with_metrics, path_run_log)
+
+
+def restore_database_indexes(
+    db_name,
+    path_local_archives=PATH_MONGO_LOCAL_ARCHIVES,
+    mongo_client_local=None,
+    verbose=False,
+):
+    """Builds the indexes described in the <collection>.metadata.json files of a
+    dumped database (to use after restore_database(..., no_index_restore=True))
+    returns (output, error), output being {collection: [index names]}
+    """
+    if mongo_client_local is None:
+        mongo_client_local = get_mongo_client("local")
+    db = mongo_client_local[db_name]
+
+    output, error = dict(), None
+    try:
+        for path_metadata in sorted(Path(path_local_archives / db_name).iterdir()):
+            if not path_metadata.name.endswith(".metadata.json"):
+                continue
+            coll_name = path_metadata.name.removesuffix(".metadata.json")
+            with open(path_metadata, "r") as file:
+                metadata = json_util.loads(file.read())
+            indexes = [
+                {k: v for (k, v) in index.items() if k not in ["v", "ns"]}
+                for index in metadata.get("indexes", [])
+                if index["name"] != "_id_"
+            ]
+            if indexes:
+                db.command("createIndexes", coll_name, indexes=indexes)
+            output[coll_name] = [index["name"] for index in indexes]
+    except Exception as e:
+        output, error = None, e
+    finally:
+        if verbose:
+            print(f"- indexing db '{db_name}'" + (error is not None) * " (ERROR)")
         return (output, error)
 
 
+def get_archives_database_names(path_local_archives=PATH_MONGO_LOCAL_ARCHIVES):
+    return sorted(p.name for p in Path(path_local_archives).iterdir() if p.is_dir())
+
+
 def restore_databases(
     db_name: str | list[str] | None = None,
     path_local_archives=PATH_MONGO_LOCAL_ARCHIVES,
-    mongo_client_local=MONGO_CLIENTS["local"],
+    mongo_client_local=None,
     verbose=False,
     debug=False,
+    max_workers: int = 1,
+    num_parallel_collections: int | None = None,
+    num_insertion_workers: int | None = None,
+    defer_indexes=False,
+    with_metrics=False,
+    path_run_log=None,
 ):
+    """Restores several databases on the local MongoDB server
+    up to max_workers mongorestore processes run at the same time, largest
+    archives first so that a big tenant doesn't end up restoring alone.
+    with defer_indexes=True, the data of all databases is restored first, then
+    the indexes are built in a second pass: each output is then
+    [out_restore, out_indexes]. Outputs are in the same order as db_name.
+    """
     if isinstance(db_name, str):
         db_name = [db_name]
     if db_name is None:
-        db_name = list_database_names(MONGO_CLIENTS[env])
+        db_name = get_archives_database_names(path_local_archives)
+
+    def restore(dbn):
+        return restore_database(
+            dbn,
+            path_local_archives,
+            mongo_client_local,
+            verbose=verbose,
+            debug=debug,
+            num_parallel_collections=num_parallel_collections,
+            num_insertion_workers=num_insertion_workers,
+            no_index_restore=defer_indexes,
+            with_metrics=with_metrics,
+            path_run_log=path_run_log,
+        )
 
-    outputs = list()
-    for dbn in tqdm(db_name):
-        out = restore_database(dbn, path_local_archives, verbose, debug)
-        outputs.append(out)
+    ## schedule the largest archives first, then put outputs back in order
+    sizes = {dbn: get_archive_size(path_local_archives / dbn) for dbn in db_name}
+    scheduled = sorted(db_name, key=lambda dbn: sizes[dbn], reverse=True)
+    outs = dict(zip(scheduled, run_in_thread_pool(restore, scheduled, max_workers)))
+    outputs = [outs[dbn] for dbn in db_name]
+
+    if defer_indexes:
+
+        def restore_indexes(dbn):
+            return restore_database_indexes(
+                dbn, path_local_archives, mongo_client_local, verbose
+            )
+
+        restored = [dbn for (dbn, out) in zip(db_name, outputs) if out[1] is None]
+        outs_indexes = dict(
+            zip(restored, run_in_thread_pool(restore_indexes, restored, max_workers))
+        )
+        outputs = [[out, outs_indexes.get(dbn)] for (dbn, out) in zip(db_name, outputs)]
     return outputs
 
 
 def restore_databases_batch(
-    path_local_archives=PATH_MONGO_LOCAL_ARCHIVES, verbose=False, debug=False
+    path_local_archives=PATH_MONGO_LOCAL_ARCHIVES,
+    verbose=False,
+    debug=False,
+    num_parallel_collections: int | None = None,
+    num_insertion_workers: int | None = None,
+    with_metrics=False,
+    path_run_log=None,
 ):
+    """Restores all the archives of path_local_archives with one mongorestore
+    with_metrics: see dump_database (stage "restore_batch", no db_name)
+    """
     command = ["mongorestore", "--drop", str(path_local_archives)]
+    command += build_mongorestore_options(
+        num_parallel_collections, num_insertion_workers
+    )
 
     if debug:
         print(" ".join(command))
+    started_at, start = datetime.now(), time.perf_counter()
     try:
         output = subprocess.run(command, capture_output=True, check=True)
         error = None
@@ -208,7 +515,20 @@ def restore_databases_batch(
         output = None
         error = e
     finally:
-        return (output, error)
+        if verbose:
+            print("- restoring all archives" + (error is not None) * " (ERROR)")
+        metrics = build_operation_metrics(
+            "restore_batch",
+            None,
+            started_at,
+            time.perf_counter() - start,
+            error,
+            nb_bytes=get_archive_size(Path(path_local_archives)),
+            nb_docs=count_documents_in_logs(
+                (output or error).stderr, MONGORESTORE_DOCS_PATTERN
+            ),
+        )
+        return return_with_metrics((output, error), metrics, with_metrics, path_run_log)
 
 
 def pull_database(
@@ -218,15 +538,125 @@ def pull_database(
     verbose=False,
     debug=False,
     config=CONFIG,
+    stream=False,
+    with_metrics=False,
+    path_run_log=None,
 ):
     """Dumps a database from remote cluster and restores it to local
     corresponds to: dump_database + restore_database
+    with stream=True, the dump is piped into the restore without writing
+    any archive on disk (see stream_database)
+    with_metrics: see dump_database
     """
-    out_dump = dump_database(env, db_name, path_local_archives, verbose, debug, config)
-    out_restore = restore_database(db_name, path_local_archives, verbose, debug)
+    metrics_kwargs = dict(with_metrics=with_metrics, path_run_log=path_run_log)
+    if stream:
+        return stream_database(env, db_name, verbose, debug, config, **metrics_kwargs)
+    out_dump = dump_database(
+        env, db_name, path_local_archives, verbose, debug, config, **metrics_kwargs
+    )
+    out_restore = restore_database(
+        db_name, path_local_archives, verbose=verbose, debug=debug, **metrics_kwargs
+    )
     return [out_dump, out_restore]
 
 
+def stream_database(
+    env,
+    db_name,
+    verbose=False,
+    debug=False,
+    config=CONFIG,
+    with_metrics=False,
+    path_run_log=None,
+):
+    """Pipes `mongodump --archive --gzip` into `mongorestore --archive --gzip`
+    so the database is restored locally without intermediate files.
+
+    Returns [out_dump, out_restore] like pull_database: one (output, error)
+    per process, with its own stderr and exit code.
+    """
+    dump_command = build_mongodump_command(env, db_name, config) + [
+        "--archive",
+        "--gzip",
+    ]
+    restore_command = [
+        "mongorestore",
+        "--drop",
+        "--archive",
+        "--gzip",
+        "--nsInclude",
+        f"{db_name}.*",
+    ]
+
+    if debug:
+        print("command: " + " ".join(dump_command) + " | " + " ".join(restore_command))
+
+    started_at, start = datetime.now(), time.perf_counter()
+    ## mongodump stderr goes to a file: reading it from a pipe while
+    ## mongorestore consumes stdout could otherwise deadlock
+    with tempfile.TemporaryFile() as dump_stderr:
+        dump_process = subprocess.Popen(
+            dump_command, stdout=subprocess.PIPE, stderr=dump_stderr
+        )
+        restore_process = subprocess.Popen(
+            restore_command,
+            stdin=dump_process.stdout,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        ## let mongodump receive SIGPIPE if mongorestore exits early
+        dump_process.stdout.close()
+        restore_stdout, restore_stderr = restore_process.communicate()
+        dump_process.wait()
+        dump_stderr.seek(0)
+        dump_stderr = dump_stderr.read()
+    duration = time.perf_counter() - start
+
+    outs = list()
+    for stage, command, returncode, stdout, stderr, docs_pattern in [
+        (
+            "stream_dump",
+            dump_command,
+            dump_process.returncode,
+            None,
+            dump_stderr,
+            MONGODUMP_DOCS_PATTERN,
+        ),
+        (
+            "stream_restore",
+            restore_command,
+            restore_process.returncode,
+            restore_stdout,
+            restore_stderr,
+            MONGORESTORE_DOCS_PATTERN,
+        ),
+    ]:
+        if returncode == 0:
+            out = (
+                subprocess.CompletedProcess(command, returncode, stdout, stderr),
+                None,
+            )
+        else:
+            out = (
+                None,
+                subprocess.CalledProcessError(returncode, command, stdout, stderr),
+            )
+        metrics = build_operation_metrics(
+            stage,
+            db_name,
+            started_at,
+            duration,
+            out[1],
+            nb_docs=count_documents_in_logs(stderr, docs_pattern),
+        )
+        outs.append(return_with_metrics(out, metrics, with_metrics, path_run_log))
+
+    if verbose:
+        has_error = any(out[1] is not None for out in outs)
+        print(f"- streaming db '{db_name}'" + has_error * " (ERROR)")
+    return outs
+
+
 def pull_databases(
     env,
     db_name,
@@ -235,11 +665,46 @@ def pull_databases(
     debug=False,
     config=CONFIG,
     restore_in_batch=False,
+    pipelined=False,
+    max_pending_archives=1,
+    remove_archives=False,
+    incremental=False,
+    with_metrics=False,
+    path_run_log=None,
 ):
+    metrics_kwargs = dict(with_metrics=with_metrics, path_run_log=path_run_log)
     if isinstance(db_name, str):
         db_name = [db_name]
     if db_name is None:
-        db_name = list_database_names(MONGO_CLIENTS[env])
+        db_name = get_all_database_names(get_mongo_client(env))
+
+    ## only pull the databases (and collections) that changed since last pull
+    if incremental:
+        if pipelined or restore_in_batch:
+            raise ValueError("incremental can't be combined with other pull modes")
+        return pull_databases_incremental(
+            env,
+            db_name,
+            path_local_archives=path_local_archives,
+            verbose=verbose,
+            debug=debug,
+            config=config,
+            **metrics_kwargs,
+        )
+
+    ## dump the next databases while the previous one is being restored
+    if pipelined:
+        return pull_databases_pipelined(
+            env,
+            db_name,
+            path_local_archives=path_local_archives,
+            verbose=verbose,
+            debug=debug,
+            config=config,
+            max_pending_archives=max_pending_archives,
+            remove_archives=remove_archives,
+            **metrics_kwargs,
+        )
 
     outputs = list()
 
@@ -247,10 +712,12 @@ def pull_databases(
     if restore_in_batch:
         for dbn in tqdm(db_name):
             out_dump = dump_database(
-                env, dbn, path_local_archives, verbose, debug, config
+                env, dbn, path_local_archives, verbose, debug, config, **metrics_kwargs
             )
             outputs.append(out_dump)
-        out_restore = restore_databases_batch()
+        out_restore = restore_databases_batch(
+            path_local_archives, verbose, debug, **metrics_kwargs
+        )
         outputs.append(out_restore)
         return outputs
 
@@ -258,14 +725,263 @@ def pull_databases(
     else:
         for dbn in tqdm(db_name):
             out_dump = dump_database(
-                env, dbn, path_local_archives, verbose, debug, config
+                env, dbn, path_local_archives, verbose, debug, config, **metrics_kwargs
+            )
+            out_restore = restore_database(
+                dbn,
+                path_local_archives,
+                verbose=verbose,
+                debug=debug,
+                **metrics_kwargs,
             )
-            out_restore = restore_database(dbn, path_local_archives, verbose, debug)
             outs = [out_dump, out_restore]
             outputs.append(outs)
         return outputs
 
 
+def pull_databases_pipelined(
+    env,
+    db_name: list[str],
+    path_local_archives=PATH_MONGO_LOCAL_ARCHIVES,
+    verbose=False,
+    debug=False,
+    config=CONFIG,
+    max_pending_archives=1,
+    remove_archives=False,
+    with_metrics=False,
+    path_run_log=None,
+):
+    """Dumps and restores databases as a producer/consumer pipeline:
+    a background thread dumps the databases while the main thread restores the
+    archives that are ready. At most max_pending_archives dumped databases wait
+    for their restore; with remove_archives=True each archive is deleted once
+    restored (or if its dump failed), which caps the disk used by the archives;
+    the archives whose restore failed are kept, to retry the restore.
+
+    Returns one [out_dump, out_restore, timings] per database, in order.
+    out_restore is None when the dump failed.
+    """
+    metrics_kwargs = dict(with_metrics=with_metrics, path_run_log=path_run_log)
+    pending = queue.Queue(maxsize=max(1, max_pending_archives))
+
+    def produce():
+        try:
+            for dbn in db_name:
+                start = time.perf_counter()
+                out_dump = dump_database(
+                    env,
+                    dbn,
+                    path_local_archives,
+                    verbose,
+                    debug,
+                    config,
+                    **metrics_kwargs,
+                )
+                pending.put((dbn, out_dump, time.perf_counter() - start))
+        finally:
+            pending.put(None)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    outputs = list()
+    with tqdm(total=len(db_name)) as pbar:
+        while True:
+            start = time.perf_counter()
+            item = pending.get()
+            wait_time = time.perf_counter() - start
+            if item is None:
+                break
+
+            dbn, out_dump, dump_time = item
+            start = time.perf_counter()
+            out_restore = None
+            if out_dump[1] is None:
+                out_restore = restore_database(
+                    dbn,
+                    path_local_archives,
+                    verbose=verbose,
+                    debug=debug,
+                    **metrics_kwargs,
+                )
+            restore_time = time.perf_counter() - start
+            ## keep an archive whose restore failed: it is needed to retry
+            restore_failed = out_restore is not None and out_restore[1] is not None
+            if remove_archives and not restore_failed:
+                shutil.rmtree(Path(path_local_archives) / dbn, ignore_errors=True)
+
+            timings = {
+                "db_name": dbn,
+                "dump_time": dump_time,
+                "restore_time": restore_time,
+                "wait_time": wait_time,
+            }
+            outputs.append([out_dump, out_restore, timings])
+            pbar.update(1)
+    producer.join()
+
+    if verbose:
+        total_dump = sum(o[2]["dump_time"] for o in outputs)
+        total_restore = sum(o[2]["restore_time"] for o in outputs)
+        total_wait = sum(o[2]["wait_time"] for o in outputs)
+        print(
+            f"dump: {total_dump:.1f}s - restore: {total_restore:.1f}s"
+            f" - restore waiting for dumps: {total_wait:.1f}s"
+        )
+    return outputs
+
+
+### incremental pulls
+def get_database_fingerprint(mongo_client, db_name, with_updated_at=True):
+    """Summarizes the state of a database, to detect changes between two pulls:
+    dbStats sizes, and per collection the document count, the max _id and
+    the max updatedAt (sorting on updatedAt scans collections without index)
+    """
+    db = mongo_client[db_name]
+    stats = db.command("dbStats")
+    collections = dict()
+    for coll_name in sorted(db.list_collection_names()):
+        coll = db[coll_name]
+        last_doc = coll.find_one({}, projection={"_id": 1}, sort=[("_id", -1)])
+        coll_fingerprint = {
+            "count": coll.estimated_document_count(),
+            "max_id": str(last_doc["_id"]) if last_doc is not None else None,
+        }
+        if with_updated_at:
+            last_updated = coll.find_one(
+                {"updatedAt": {"$exists": True}},
+                projection={"updatedAt": 1},
+                sort=[("updatedAt", -1)],
+            )
+            coll_fingerprint["max_updated_at"] = (
+                str(last_updated["updatedAt"]) if last_updated is not None else None
+            )
+        collections[coll_name] = coll_fingerprint
+
+    return {
+        "objects": stats["objects"],
+        "data_size": stats["dataSize"],
+        "storage_size": stats["storageSize"],
+        "index_size": stats["indexSize"],
+        "collections": collections,
+    }
+
+
+def get_changed_collections(previous, current):
+    """Compares two fingerprints (see get_database_fingerprint)
+    returns None if the whole database has to be pulled, else the list of the
+    collections that changed (empty if nothing changed)
+    """
+    if previous is None:
+        return None
+    changed = [
+        coll_name
+        for (coll_name, coll_fingerprint) in current["collections"].items()
+        if previous["collections"].get(coll_name) != coll_fingerprint
+    ]
+    ## the sizes changed but no collection fingerprint did: pull everything
+    stats_keys = ["objects", "data_size"]
+    if not changed and any(previous[k] != current[k] for k in stats_keys):
+        return None
+    if len(changed) == len(current["collections"]):
+        return None
+    return changed
+
+
+def load_manifest(path_manifest=PATH_MONGO_LOCAL_MANIFEST):
+    if not Path(path_manifest).exists():
+        return dict()
+    with open(path_manifest, "r") as file:
+        return json.load(file)
+
+
+def save_manifest(manifest, path_manifest=PATH_MONGO_LOCAL_MANIFEST):
+    ## write in a temporary file first so that a crash can't corrupt the manifest
+    path_tmp = Path(f"{path_manifest}.tmp")
+    with open(path_tmp, "w") as file:
+        json.dump(manifest, file, indent=2)
+    path_tmp.replace(path_manifest)
+
+
+def pull_databases_incremental(
+    env,
+    db_name: list[str],
+    path_local_archives=PATH_MONGO_LOCAL_ARCHIVES,
+    verbose=False,
+    debug=False,
+    config=CONFIG,
+    path_manifest=PATH_MONGO_LOCAL_MANIFEST,
+    by_collection=True,
+    with_metrics=False,
+    path_run_log=None,
+):
+    """Pulls only the databases that changed since the last pull
+    fingerprints of the pulled databases are stored in the manifest. With
+    by_collection=True, only the collections that changed are dumped and restored.
+
+    Returns one [out_dump, out_restore] per database, in order
+    (None for the databases that were skipped).
+    """
+    manifest = load_manifest(path_manifest)
+    mongo_client = get_mongo_client(env)
+
+    outputs = list()
+    for dbn in tqdm(db_name):
+        fingerprint = get_database_fingerprint(mongo_client, dbn)
+        previous = manifest.get(dbn)
+        if previous is not None and previous["env"] != env:
+            previous = None
+        changed = get_changed_collections(
+            previous["fingerprint"] if previous is not None else None, fingerprint
+        )
+
+        if changed == []:
+            if verbose:
+                print(f"- skipping db '{dbn}' (unchanged)")
+            outputs.append(None)
+            continue
+
+        exclude_collections, collections = None, None
+        if changed is not None and by_collection:
+            collections = changed
+            exclude_collections = [
+                c for c in fingerprint["collections"] if c not in changed
+            ]
+        out_dump = dump_database(
+            env,
+            dbn,
+            path_local_archives,
+            verbose,
+            debug,
+            config,
+            exclude_collections=exclude_collections,
+            with_metrics=with_metrics,
+            path_run_log=path_run_log,
+        )
+        out_restore = None
+        if out_dump[1] is None:
+            out_restore = restore_database(
+                dbn,
+                path_local_archives,
+                verbose=verbose,
+                debug=debug,
+                collections=collections,
+                with_metrics=with_metrics,
+                path_run_log=path_run_log,
+            )
+        outputs.append([out_dump, out_restore])
+
+        ## only record the fingerprint once the database is restored
+        if out_restore is not None and out_restore[1] is None:
+            manifest[dbn] = {
+                "env": env,
+                "pulled_at": datetime.now().isoformat(),
+                "fingerprint": fingerprint,
+            }
+            save_manifest(manifest, path_manifest)
+    return outputs
+
+
 ### list database names
 def get_all_database_names(mongo_client):
     tmp = list(mongo_client.list_databases())
@@ -285,22 +1001,149 @@ def get_customers_database_infos(mongo_client):
         "licenseModel",
         "renewalDate",
     ]
-    workspaces = [
-        {k: v for (k, v) in e.items() if k in selected_fields}
-        for e in db_main["Workspace"].find()
-    ]
+    projection = {"_id": 0} | {k: 1 for k in selected_fields}
+    workspaces = list(db_main["Workspace"].find({}, projection=projection))
     for w in workspaces:
         w["dbName"] = w["dbUri"].split("/")[-1]
+        w["allHostnames"] = w["hostnames"]
         w["hostnames"] = w["hostnames"][0]
 
     return workspaces
 
 
-def get_customers_database_names(mongo_client):
+def get_customers_database_names(mongo_client, use_cache=True):
+    ## clients of the registry (get_mongo_client) can use the cached tenants index
+    env = next((k for (k, c) in MONGO_CLIENTS.items() if c is mongo_client), None)
+    if use_cache and env is not None:
+        return list(get_tenants_index(env)["by_db_name"])
     tmp = get_customers_database_infos(mongo_client)
     return [e["dbName"] for e in tmp]
 
 
+### cached tenants index
+TENANTS_INDEX_TTL = timedelta(hours=24)
+TENANTS_INDEXES = dict()
+
+
+def get_path_tenants_index(env):
+    return PATH_MONGO_LOCAL_DATA / f"tenants_index_{env}.json"
+
+
+def build_tenants_index(workspaces, loaded_at=None):
+    by_hostname = dict()
+    for w in workspaces:
+        for hostname in w.get("allHostnames") or [w["hostnames"]]:
+            by_hostname[hostname] = w
+    return {
+        "loaded_at": loaded_at or datetime.now(),
+        "by_db_name": {w["dbName"]: w for w in workspaces},
+        "by_hostname": by_hostname,
+    }
+
+
+def get_tenants_index(env="production", ttl=TENANTS_INDEX_TTL, refresh=False):
+    """Tenants infos (see get_customers_database_infos) indexed by dbName and hostname
+
+    The index is kept in memory and in a snapshot file; `main.Workspace` is only
+    queried when both are older than ttl (or with refresh=True).
+    """
+    index = TENANTS_INDEXES.get(env)
+    path_index = get_path_tenants_index(env)
+    if index is None and not refresh and path_index.exists():
+        with open(path_index, "r") as file:
+            snapshot = json_util.loads(file.read())
+        index = build_tenants_index(snapshot["workspaces"], snapshot["loaded_at"])
+
+    if refresh or index is None or datetime.now() - index["loaded_at"] > ttl:
+        workspaces = get_customers_database_infos(get_mongo_client(env))
+        index = build_tenants_index(workspaces)
+        path_index.parent.mkdir(parents=True, exist_ok=True)
+        with open(path_index, "w") as file:
+            file.write(
+                json_util.dumps(
+                    {"loaded_at": index["loaded_at"], "workspaces": workspaces}
+                )
+            )
+
+    TENANTS_INDEXES[env] = index
+    return index
+
+
+def get_tenant(db_name=None, hostname=None, env="production"):
+    """O(1) lookup of a tenant by db name or hostname (None if unknown)"""
+    index = get_tenants_index(env)
+    if db_name is not None:
+        return index["by_db_name"].get(db_name)
+    if hostname is not None:
+        return index["by_hostname"].get(hostname)
+    raise ValueError("db_name or hostname should be given")
+
+
+### aggregations over all customers databases
+def aggregate_customers_databases(
+    mongo_client,
+    coll_name: str,
+    pipeline: list[dict],
+    db_names: list[str] | None = None,
+    max_workers: int = 8,
+    display_progress=True,
+):
+    """Runs an aggregation pipeline on coll_name in every customer database,
+    with up to max_workers databases queried at once.
+    Returns one DataFrame of all results, with a db_name column.
+    """
+    if db_names is None:
+        db_names = get_customers_database_names(mongo_client)
+
+    def aggregate(dbn):
+        res = list(mongo_client[dbn][coll_name].aggregate(pipeline, allowDiskUse=True))
+        for e in res:
+            e["db_name"] = dbn
+        return res
+
+    results = run_in_thread_pool(aggregate, db_names, max_workers, display_progress)
+    return pd.DataFrame([e for res in results for e in res])
+
+
+def count_pubs_by_type(mongo_client, db_names=None, max_workers=8):
+    """Number of publications and last created / updated dates, per db and type"""
+    pipeline = [
+        {
+            "$group": {
+                "_id": "$_cls",
+                "nb": {"$sum": 1},
+                "last_created_date": {"$max": "$date_created"},
+                "last_updated_date": {"$max": "$date_updated"},
+            }
+        },
+        {"$addFields": {"pub_type": "$_id"}},
+        {"$project": {"_id": 0}},
+    ]
+    return aggregate_customers_databases(
+        mongo_client, COLL_PUBLICATIONS, pipeline, db_names, max_workers
+    )
+
+
+def get_active_learners_group_pubs(mongo_client, db_names=None, max_workers=8):
+    """Ids of the publications linked to a learners group that has not expired"""
+    pipeline = [
+        {
+            "$match": {
+                "$or": [
+                    {"expirationDate": None},
+                    {"expirationDate": {"$gt": datetime.now()}},
+                ]
+            }
+        },
+        {"$unwind": "$publications"},
+        {"$group": {"_id": "$publications"}},
+        {"$project": {"_id": 0, "pub_id": {"$toString": "$_id"}}},
+    ]
+    return aggregate_customers_databases(
+        mongo_client, "learners_group", pipeline, db_names, max_workers
+    )
+
+
 def print_stderr(out):
     print(out.stderr.decode("utf-8"))
 
@@ -357,22 +1200,64 @@ class PUB_TYPE(Enum):
     ADAPTIVE = "Publication.Adaptive"
 
 
-def get_pubs(client, db_name):
+def iter_collection(
+    client,
+    db_name,
+    coll_name,
+    filter: dict | None = None,
+    projection: dict | list | None = None,
+    batch_size: int = 1000,
+):
+    """Yields the documents of a collection one by one (with db_name attached),
+    fetching them from the server batch_size at a time
+    """
+    cursor = client[db_name][coll_name].find(
+        filter or {}, projection=projection, batch_size=batch_size
+    )
+    for doc in cursor:
+        doc["db_name"] = db_name
+        yield doc
+
+
+def iter_customers_collection(
+    client,
+    coll_name,
+    db_names: list[str] | None = None,
+    filter: dict | None = None,
+    projection: dict | list | None = None,
+    batch_size: int = 1000,
+):
+    """Same as iter_collection, chained over all customers databases"""
+    if db_names is None:
+        db_names = get_customers_database_names(client)
+    for dbn in db_names:
+        yield from iter_collection(
+            client, dbn, coll_name, filter, projection, batch_size
+        )
+
+
+def iter_pubs(client, db_name, filter=None, projection=None, batch_size=1000):
+    return iter_collection(
+        client, db_name, COLL_PUBLICATIONS, filter, projection, batch_size
+    )
+
+
+def iter_learners_group(client, db_name, filter=None, projection=None, batch_size=1000):
+    return iter_collection(
+        client, db_name, "learners_group", filter, projection, batch_size
+    )
+
+
+def get_pubs(client, db_name, filter=None, projection=None):
     # input: db_name
     # output: list of all publication
-    res = list(client[db_name][COLL_PUBLICATIONS].find({}))
-    for pub in res:
-        pub["db_name"] = db_name
-    return res
+    return list(iter_pubs(client, db_name, filter, projection))
 
 
-def get_learners_group(client, db_name):
+def get_learners_group(client, db_name, filter=None, projection=None):
     # input: db_name
     # output: list of all publication
-    res = list(client[db_name]["learners_group"].find({}))
-    for pub in res:
-        pub["db_name"] = db_name
-    return res
+    return list(iter_learners_group(client, db_name, filter, projection))
 
 
 def get_pub_type(pub):
@@ -389,16 +1274,141 @@ def is_pub_category(pub, cat: PUB_TYPE):
     return pub["_cls"] == cat.value
 
 
+## fields holding the publication hierarchy (publication > chapters > modules)
+## assumed names: no other code reads them, adjust if the schema differs
+PUB_CHAPTERS_FIELD = "chapters"
+PUB_MODULES_FIELD = "modules"
+PUB_TABLES_PROJECTION = {
+    "_cls": 1,
+    "name": 1,
+    "date_created": 1,
+    "date_updated": 1,
+    PUB_CHAPTERS_FIELD: 1,
+    PUB_MODULES_FIELD: 1,
+}
+
+PUB_TABLES_COLUMNS = {
+    "pubs": [
+        "pub_id",
+        "db_name",
+        "name",
+        "pub_type",
+        "date_created",
+        "date_updated",
+        "nb_chapters",
+        "nb_modules",
+    ],
+    "chapters": ["chapter_id", "pub_id", "db_name", "position", "name", "nb_modules"],
+    "modules": ["module_id", "chapter_id", "pub_id", "db_name", "position", "name"],
+}
+
+
 def get_pub_chapters(pub):
-    # input: list of publications (dict)
-    # the publication type
-    return
+    # input: publication (dict)
+    # output: list of chapters of the publication
+    return pub.get(PUB_CHAPTERS_FIELD) or []
+
+
+def get_chapter_modules(chapter):
+    # modules of a chapter reference (not embedded) are unknown: none counted
+    if not isinstance(chapter, dict):
+        return []
+    return chapter.get(PUB_MODULES_FIELD) or []
 
 
 def get_pub_modules(pub):
-    # input: list of publications (dict)
-    # the publication type
-    modules = list()
+    # input: publication (dict)
+    # output: list of (chapter, module) of the publication
+    # chapter is None for modules placed directly in the publication
+    modules = [(None, m) for m in pub.get(PUB_MODULES_FIELD) or []]
+    for chapter in get_pub_chapters(pub):
+        modules += [(chapter, m) for m in get_chapter_modules(chapter)]
+    return modules
+
+
+def get_element_id(e):
+    # chapters and modules are either embedded documents or references
+    if isinstance(e, dict):
+        return str(e.get("_id", e.get("id")))
+    return str(e)
+
+
+def get_element_name(e):
+    return e.get("name") if isinstance(e, dict) else None
+
+
+def build_pubs_tables(pubs):
+    """Flattens publications into 3 tables: publications, chapters and modules
+    linked by pub_id / chapter_id, with categorical dtypes for the repeated values
+    (db_name, pub_type) so that group-bys over all tenants stay cheap.
+    The hierarchy is read from the fields PUB_CHAPTERS_FIELD / PUB_MODULES_FIELD
+    (assumed names); chapters and modules stored as references (ids) have no
+    name, and chapter references count 0 modules.
+    """
+    rows_pubs, rows_chapters, rows_modules = list(), list(), list()
+    for pub in pubs:
+        pub_id = str(pub["_id"])
+        chapters = get_pub_chapters(pub)
+        modules = get_pub_modules(pub)
+        rows_pubs.append(
+            {
+                "pub_id": pub_id,
+                "db_name": pub.get("db_name"),
+                "name": pub.get("name"),
+                "pub_type": pub.get("_cls"),
+                "date_created": pub.get("date_created"),
+                "date_updated": pub.get("date_updated"),
+                "nb_chapters": len(chapters),
+                "nb_modules": len(modules),
+            }
+        )
+        for i, chapter in enumerate(chapters):
+            rows_chapters.append(
+                {
+                    "chapter_id": get_element_id(chapter),
+                    "pub_id": pub_id,
+                    "db_name": pub.get("db_name"),
+                    "position": i,
+                    "name": get_element_name(chapter),
+                    "nb_modules": len(get_chapter_modules(chapter)),
+                }
+            )
+        positions = dict()
+        for chapter, module in modules:
+            chapter_id = get_element_id(chapter) if chapter is not None else None
+            positions[chapter_id] = positions.get(chapter_id, -1) + 1
+            rows_modules.append(
+                {
+                    "module_id": get_element_id(module),
+                    "chapter_id": chapter_id,
+                    "pub_id": pub_id,
+                    "db_name": pub.get("db_name"),
+                    "position": positions[chapter_id],
+                    "name": get_element_name(module),
+                }
+            )
+
+    df_pubs = pd.DataFrame(rows_pubs, columns=PUB_TABLES_COLUMNS["pubs"])
+    df_chapters = pd.DataFrame(rows_chapters, columns=PUB_TABLES_COLUMNS["chapters"])
+    df_modules = pd.DataFrame(rows_modules, columns=PUB_TABLES_COLUMNS["modules"])
+
+    pub_types = pd.CategoricalDtype([e.value for e in PUB_TYPE])
+    df_pubs["pub_type"] = df_pubs["pub_type"].astype(pub_types)
+    for df in [df_pubs, df_chapters, df_modules]:
+        df["db_name"] = df["db_name"].astype("category")
+    ## foreign keys are repeated a lot in the child tables
+    df_chapters["pub_id"] = df_chapters["pub_id"].astype("category")
+    df_modules["pub_id"] = df_modules["pub_id"].astype("category")
+    df_modules["chapter_id"] = df_modules["chapter_id"].astype("category")
+    return df_pubs, df_chapters, df_modules
+
+
+def build_customers_pubs_tables(client, db_names: list[str] | None = None):
+    """build_pubs_tables over the publications of all customers databases"""
+    pubs = iter_customers_collection(
+        client, COLL_PUBLICATIONS, db_names, projection=PUB_TABLES_PROJECTION
+    )
+    return build_pubs_tables(pubs)
 
 
 def cast_to_string(obj):
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import shutil
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from utils import (
+    PATH_MONGO_LOCAL_ARCHIVES,
+    PATH_MONGO_LOCAL_DATA,
+    get_archives_database_names,
+    restore_databases,
+)
+
+## snapshots/<snapshot name>/<db_name>/... : hardlinks to snapshots/objects/
+PATH_MONGO_LOCAL_SNAPSHOTS = PATH_MONGO_LOCAL_DATA / "snapshots"
+SNAPSHOT_NAME_FORMAT = "%Y-%m-%dT%H-%M-%S"
+## snapshots can have any name: their date is kept in this file
+SNAPSHOT_METADATA_FILE = ".snapshot.json"
+OBJECTS_DIR = "objects"
+
+
+### content-addressed store
+def hash_file(path, chunk_size=2**20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def store_object(path_file, path_snapshots=PATH_MONGO_LOCAL_SNAPSHOTS):
+    """Copies a file in the object store (if its content isn't already there)
+    and returns the path of the stored object
+    """
+    digest = hash_file(path_file)
+    path_object = Path(path_snapshots) / OBJECTS_DIR / digest[:2] / digest
+    if not path_object.exists():
+        path_object.parent.mkdir(parents=True, exist_ok=True)
+        ## copy rather than link: mongodump rewrites the archive files in place
+        path_tmp = path_object.with_suffix(".tmp")
+        shutil.copyfile(path_file, path_tmp)
+        path_tmp.replace(path_object)
+    return path_object
+
+
+### snapshots
+def create_snapshot(
+    db_name: str | list[str] | None = None,
+    path_local_archives=PATH_MONGO_LOCAL_ARCHIVES,
+    path_snapshots=PATH_MONGO_LOCAL_SNAPSHOTS,
+    snapshot_name: str | None = None,
+):
+    """Saves the current archives of db_name (default: all archived databases)
+    as a timestamped snapshot. Files already stored by a previous snapshot
+    (same content) are hardlinked, so they don't take more disk space.
+    snapshot_name defaults to the current date; any name can be given
+    (e.g. "before-migration"), the creation date is stored with the snapshot.
+    Returns the snapshot path, which can be used as path_local_archives.
+    """
+    if isinstance(db_name, str):
+        db_name = [db_name]
+    if db_name is None:
+        db_name = get_archives_database_names(path_local_archives)
+    if snapshot_name is None:
+        snapshot_name = datetime.now().strftime(SNAPSHOT_NAME_FORMAT)
+
+    path_snapshot = Path(path_snapshots) / snapshot_name
+    for dbn in db_name:
+        path_archive = Path(path_local_archives) / dbn
+        for path_file in sorted(path_archive.rglob("*")):
+            if not path_file.is_file():
+                continue
+            path_link = path_snapshot / dbn / path_file.relative_to(path_archive)
+            path_link.parent.mkdir(parents=True, exist_ok=True)
+            if path_link.exists():
+                path_link.unlink()
+            os.link(store_object(path_file, path_snapshots), path_link)
+    path_snapshot.mkdir(parents=True, exist_ok=True)
+    with open(path_snapshot / SNAPSHOT_METADATA_FILE, "w") as file:
+        json.dump({"created_at": datetime.now().isoformat()}, file)
+    return path_snapshot
+
+
+def list_snapshots(db_name=None, path_snapshots=PATH_MONGO_LOCAL_SNAPSHOTS):
+    """Snapshot names, oldest first (only those containing db_name, if given)"""
+    if not Path(path_snapshots).exists():
+        return list()
+    names = [
+        p.name
+        for p in Path(path_snapshots).iterdir()
+        if p.is_dir()
+        and p.name != OBJECTS_DIR
+        and (db_name is None or (p / db_name).is_dir())
+    ]
+    return sorted(names, key=lambda n: (get_snapshot_date(n, path_snapshots), n))
+
+
+def get_snapshot_date(snapshot_name, path_snapshots=PATH_MONGO_LOCAL_SNAPSHOTS):
+    """Creation date of a snapshot: from its metadata file, else from its name
+    (default format), else the modification date of its directory
+    """
+    path_snapshot = Path(path_snapshots) / snapshot_name
+    path_metadata = path_snapshot / SNAPSHOT_METADATA_FILE
+    if path_metadata.exists():
+        with open(path_metadata) as file:
+            return datetime.fromisoformat(json.load(file)["created_at"])
+    try:
+        return datetime.strptime(snapshot_name, SNAPSHOT_NAME_FORMAT)
+    except ValueError:
+        return datetime.fromtimestamp(path_snapshot.stat().st_mtime)
+
+
+def delete_unreferenced_objects(path_snapshots=PATH_MONGO_LOCAL_SNAPSHOTS):
+    """Deletes the stored objects no snapshot links to anymore"""
+    nb_deleted = 0
+    for path_object in (Path(path_snapshots) / OBJECTS_DIR).rglob("*"):
+        if path_object.is_file() and path_object.stat().st_nlink == 1:
+            path_object.unlink()
+            nb_deleted += 1
+    return nb_deleted
+
+
+def apply_retention(
+    keep_last: int | None = None,
+    max_age: timedelta | None = None,
+    path_snapshots=PATH_MONGO_LOCAL_SNAPSHOTS,
+):
+    """Deletes the snapshots beyond the keep_last most recent ones and / or
+    older than max_age, then the objects they were the last to use.
+    Returns the names of the deleted snapshots.
+    """
+    snapshots = list_snapshots(path_snapshots=path_snapshots)
+    to_delete = set()
+    if keep_last is not None:
+        to_delete |= set(snapshots[: max(0, len(snapshots) - keep_last)])
+    if max_age is not None:
+        oldest = datetime.now() - max_age
+        to_delete |= {
+            s for s in snapshots if get_snapshot_date(s, path_snapshots) < oldest
+        }
+
+    for snapshot_name in sorted(to_delete):
+        shutil.rmtree(Path(path_snapshots) / snapshot_name)
+    delete_unreferenced_objects(path_snapshots)
+    return sorted(to_delete)
+
+
+def restore_snapshot(
+    db_name: str | list[str] | None = None,
+    snapshot_name: str | None = None,
+    path_snapshots=PATH_MONGO_LOCAL_SNAPSHOTS,
+    **kwargs,
+):
+    """Restores databases from a snapshot (default: the latest one containing
+    db_name) on the local server; kwargs are passed to restore_databases
+    """
+    if snapshot_name is None:
+        dbn = db_name if isinstance(db_name, str) else None
+        snapshots = list_snapshots(dbn, path_snapshots)
+        if not snapshots:
+            raise ValueError(f"no snapshot found for '{db_name}'")
+        snapshot_name = snapshots[-1]
+    return restore_databases(
+        db_name, path_local_archives=Path(path_snapshots) / snapshot_name, **kwargs
+    )
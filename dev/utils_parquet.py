@@ -0,0 +1,174 @@
+import json
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from bson import Decimal128, ObjectId
+from utils import (
+    PATH_MONGO_LOCAL_DATA,
+    get_customers_database_names,
+    run_in_thread_pool,
+)
+
+PATH_PARQUET_EXPORTS = PATH_MONGO_LOCAL_DATA / "parquet"
+
+
+### BSON -> Arrow conversion
+def convert_bson_value(value):
+    """Converts a BSON value to a type Arrow can store in a flat column:
+    ObjectId -> str, Decimal128 -> float, nested documents / arrays -> JSON string
+    """
+    if value is None or isinstance(value, (bool, int, float, str, datetime)):
+        return value
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return float(value.to_decimal())
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str, ensure_ascii=False)
+    return str(value)
+
+
+def convert_bson_document(doc):
+    return {k: convert_bson_value(v) for (k, v) in doc.items()}
+
+
+def get_value_kind(value):
+    """Arrow type family of a converted value (int and float mix as float)"""
+    if isinstance(value, bool):
+        return bool
+    if isinstance(value, (int, float)):
+        return float
+    return type(value)
+
+
+def build_record_batch(rows):
+    """Record batch with a column for every key of the rows (the documents of a
+    collection don't all have the same fields); a field whose values have
+    different types (e.g. int in one document, str in another) is stored as str
+    """
+    keys = list(dict.fromkeys(k for row in rows for k in row))
+    arrays = list()
+    for key in keys:
+        values = [row.get(key) for row in rows]
+        kinds = {get_value_kind(v) for v in values if v is not None}
+        if len(kinds) > 1:
+            values = [str(v) if v is not None else None for v in values]
+        arrays.append(pa.array(values))
+    return pa.RecordBatch.from_arrays(arrays, names=keys)
+
+
+def iter_record_batches(docs, batch_size=10_000):
+    """Groups documents into Arrow record batches of at most batch_size rows"""
+    rows = list()
+    for doc in docs:
+        rows.append(convert_bson_document(doc))
+        if len(rows) == batch_size:
+            yield build_record_batch(rows)
+            rows = list()
+    if rows:
+        yield build_record_batch(rows)
+
+
+def unify_export_schemas(schemas):
+    """Schema of all the exported files: the types of a field are promoted
+    when possible (e.g. null -> int -> float), else the field is read as str
+    """
+    fields = dict()
+    for schema in schemas:
+        for field in schema:
+            fields.setdefault(field.name, list()).append(field)
+    unified = list()
+    for name, fields_name in fields.items():
+        try:
+            unified.append(
+                pa.unify_schemas(
+                    [pa.schema([f]) for f in fields_name],
+                    promote_options="permissive",
+                ).field(name)
+            )
+        except (pa.ArrowTypeError, pa.ArrowInvalid):
+            unified.append(pa.field(name, pa.string()))
+    return pa.schema(unified)
+
+
+### Mongo -> Parquet export
+def export_collection_to_parquet(
+    client,
+    db_name,
+    coll_name,
+    path_export=PATH_PARQUET_EXPORTS,
+    filter: dict | None = None,
+    projection: dict | list | None = None,
+    batch_size: int = 10_000,
+):
+    """Streams a collection into <path_export>/<coll_name>/db_name=<db_name>/,
+    one Parquet file per record batch. The partition is replaced if it exists.
+    Returns the number of exported documents.
+    """
+    path_partition = Path(path_export) / coll_name / f"db_name={db_name}"
+    shutil.rmtree(path_partition, ignore_errors=True)
+    path_partition.mkdir(parents=True)
+
+    cursor = client[db_name][coll_name].find(
+        filter or {}, projection=projection, batch_size=batch_size
+    )
+    nb_docs = 0
+    for i, batch in enumerate(iter_record_batches(cursor, batch_size)):
+        pq.write_table(
+            pa.Table.from_batches([batch]), path_partition / f"part-{i:05d}.parquet"
+        )
+        nb_docs += batch.num_rows
+    return nb_docs
+
+
+def export_customers_collection_to_parquet(
+    client,
+    coll_name,
+    db_names: list[str] | None = None,
+    path_export=PATH_PARQUET_EXPORTS,
+    filter: dict | None = None,
+    projection: dict | list | None = None,
+    batch_size: int = 10_000,
+    max_workers: int = 4,
+):
+    """export_collection_to_parquet for all customers databases
+    returns {db_name: number of exported documents}
+    """
+    if db_names is None:
+        db_names = get_customers_database_names(client)
+
+    def export(dbn):
+        return export_collection_to_parquet(
+            client, dbn, coll_name, path_export, filter, projection, batch_size
+        )
+
+    nb_docs = run_in_thread_pool(export, db_names, max_workers=max_workers)
+    return dict(zip(db_names, nb_docs))
+
+
+def read_parquet_export(
+    coll_name,
+    path_export=PATH_PARQUET_EXPORTS,
+    db_names: list[str] | None = None,
+    columns: list[str] | None = None,
+):
+    """Reads an exported collection from local Parquet files as a DataFrame,
+    optionally restricted to some databases and columns
+    """
+    path_coll = Path(path_export) / coll_name
+    files = sorted(str(p) for p in path_coll.glob("db_name=*/*.parquet"))
+    ## batches don't always have the same columns / inferred types
+    schema = unify_export_schemas(
+        [pq.read_schema(f, memory_map=True) for f in files]
+    ).append(pa.field("db_name", pa.string()))
+    dataset = ds.dataset(
+        files, schema=schema, partitioning="hive", partition_base_dir=str(path_coll)
+    )
+    dataset_filter = None
+    if db_names is not None:
+        dataset_filter = ds.field("db_name").isin(db_names)
+    return dataset.to_table(columns=columns, filter=dataset_filter).to_pandas()
@@ -3,46 +3,355 @@
 
 
 import html
+import json
+import sqlite3
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 from typing import Optional
 
 sys.path.append("../..")
 import requests
 from dev.utils import RenderJSON, load_config, render_json
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 
-
-def call_api(url: str, method: str, **kwargs):
+HTTP_POOL_SIZE = 10
+HTTP_MAX_RETRIES = 5
+HTTP_BACKOFF_FACTOR = 0.5
+HTTP_MAX_RETRY_DELAY = 60
+HTTP_RETRY_STATUSES = [429, 500, 502, 503, 504]
+## seconds to connect / to wait for the response: a hung call doesn't block forever
+HTTP_TIMEOUT = 30
+## 5xx responses and errors once the request may have been sent are only
+## retried for requests that can safely be sent twice
+HTTP_IDEMPOTENT_METHODS = ["get", "head", "put", "delete", "options"]
+## number of pages fetched at the same time by the paginated endpoints
+PAGES_MAX_WORKERS = 4
+## on-disk cache of the Circle GET responses
+PATH_HTTP_CACHE = Path(__file__).parent / "http_cache.sqlite"
+HTTP_CACHE_TTL = 3600
+HTTP_CACHE_MAX_SIZE = 100 * 2**20
+
+
+def build_session(pool_size: int = HTTP_POOL_SIZE) -> requests.Session:
+    """Session keeping up to pool_size connections alive per host"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+## shared by CircleAPI and IntercomAPI
+SESSION = build_session()
+
+
+def configure_session(pool_size: int = HTTP_POOL_SIZE):
+    """Replaces the shared session, e.g. to allow more concurrent connections"""
+    global SESSION
+    SESSION.close()
+    SESSION = build_session(pool_size)
+
+
+def get_rate_limit_delay(response) -> Optional[float]:
+    """Seconds to wait before the next call, according to the response headers:
+    Retry-After, or the Intercom X-RateLimit-* headers once the quota is used up
+    """
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            return max(
+                0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()
+            )
+    if response.headers.get("X-RateLimit-Remaining") == "0":
+        reset = response.headers.get("X-RateLimit-Reset")
+        if reset is not None:
+            return max(0.0, float(reset) - time.time())
+    return None
+
+
+def call_api(
+    url: str,
+    method: str,
+    max_retries: int = HTTP_MAX_RETRIES,
+    backoff_factor: float = HTTP_BACKOFF_FACTOR,
+    **kwargs,
+):
     """
-    Makes an API call using the specified HTTP method.
+    Makes an API call using the specified HTTP method, through the shared session.
 
     Args:
     - url (str): The URL of the API endpoint.
     - method (str): The HTTP method to use (e.g., 'get', 'post', 'put', 'delete').
-    - **kwargs: Arbitrary keyword arguments that are passed directly to requests.request.
-      These can include parameters like 'data', 'json', 'headers', and 'timeout'.
+    - max_retries (int): How many times 429 / 5xx responses and connection errors
+      are retried, waiting backoff_factor * 2**attempt seconds or what the
+      rate-limit headers ask for. For non-idempotent methods (POST), only 429s
+      and connection timeouts (the request was never sent) are retried: the
+      server may have processed a request whose response was lost.
+    - **kwargs: Arbitrary keyword arguments that are passed directly to Session.request.
+      These can include parameters like 'data', 'json', 'headers', and 'timeout'
+      (default: HTTP_TIMEOUT).
 
     Returns:
-    - response: The Response object returned by the requests call.
+    - response: The Response object returned by the requests call
+      (also when it has an HTTP error status code, after the retries).
 
     Raises:
-    - HTTPError: If the response contains an HTTP error status code.
+    - RequestException: If the request still can't be sent after the retries,
+      or right away if it may have been sent and can't be safely sent again.
     """
-    try:
-        response = requests.request(method, url, **kwargs)
-        response.raise_for_status()  # Raises an HTTPError for bad responses
-        return response
-    except requests.exceptions.HTTPError as http_err:
-        print(f"HTTP error occurred: {http_err}")  # Handle specific HTTP errors here
-    except requests.exceptions.RequestException as err:
-        print(
-            f"Error during requests to {url}: {err}"
-        )  # Handle other requests errors here
-    finally:
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    is_idempotent = method.lower() in HTTP_IDEMPOTENT_METHODS
+    for attempt in range(max_retries + 1):
+        delay = min(backoff_factor * 2**attempt, HTTP_MAX_RETRY_DELAY)
+        try:
+            response = SESSION.request(method, url, **kwargs)
+        except requests.exceptions.RequestException as err:
+            print(f"Error during requests to {url}: {err}")
+            never_sent = isinstance(err, requests.exceptions.ConnectTimeout)
+            if attempt == max_retries or not (is_idempotent or never_sent):
+                raise
+            time.sleep(delay)
+            continue
+
+        status = response.status_code
+        is_retryable = status == 429 or (
+            status in HTTP_RETRY_STATUSES and is_idempotent
+        )
+        if is_retryable and attempt < max_retries:
+            time.sleep(get_rate_limit_delay(response) or delay)
+            continue
+
+        try:
+            response.raise_for_status()  # Raises an HTTPError for bad responses
+        except requests.exceptions.HTTPError as http_err:
+            print(
+                f"HTTP error occurred: {http_err}"
+            )  # Handle specific HTTP errors here
+            return response
+
+        ## quota used up: wait for the reset instead of getting a 429 next time
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            time.sleep(min(get_rate_limit_delay(response) or 0, HTTP_MAX_RETRY_DELAY))
         return response
 
 
+class TokenBucket:
+    """Rate limiter shared by threads: acquire() blocks until a call is allowed,
+    so that at most rate_per_minute calls are made per minute on average,
+    with bursts of up to `burst` calls.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: Optional[int] = None):
+        self.rate = rate_per_minute / 60
+        self.capacity = burst if burst is not None else max(1, int(self.rate))
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                elapsed = now - self.last_refill
+                self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HTTPCache:
+    """On-disk cache of GET response bodies, keyed by URL.
+    Entries younger than ttl seconds are used without any request; older ones
+    are revalidated with their ETag / Last-Modified (a 304 costs no payload).
+    Past max_size bytes of bodies, the least recently used entries are evicted.
+    """
+
+    def __init__(
+        self,
+        path=PATH_HTTP_CACHE,
+        ttl: float = HTTP_CACHE_TTL,
+        max_size: int = HTTP_CACHE_MAX_SIZE,
+    ):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS responses (
+                    url TEXT PRIMARY KEY,
+                    body TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    stored_at REAL NOT NULL,
+                    used_at REAL NOT NULL
+                )""")
+            ## max_size may be lower than when the entries were stored
+            self.evict()
+
+    def get(self, url: str) -> Optional[dict]:
+        """{"body", "etag", "last_modified", "stored_at"} (None if not cached)"""
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT body, etag, last_modified, stored_at FROM responses"
+                " WHERE url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "UPDATE responses SET used_at = ? WHERE url = ?", (time.time(), url)
+            )
+        return dict(zip(["body", "etag", "last_modified", "stored_at"], row))
+
+    def is_fresh(self, entry: dict) -> bool:
+        return time.time() - entry["stored_at"] < self.ttl
+
+    def store(self, url: str, response):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses"
+                " (url, body, size, etag, last_modified, stored_at, used_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    response.text,
+                    len(response.content),
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                    now,
+                    now,
+                ),
+            )
+            self.evict()
+
+    def refresh(self, url: str):
+        """The cached body is still valid (304): restarts its ttl"""
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE responses SET stored_at = ?, used_at = ? WHERE url = ?",
+                (now, now, url),
+            )
+
+    def evict(self):
+        ## called with the lock held
+        total_size = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        rows = self.connection.execute(
+            "SELECT url, size FROM responses ORDER BY used_at"
+        ).fetchall()
+        for url, size in rows:
+            if total_size <= self.max_size:
+                break
+            self.connection.execute("DELETE FROM responses WHERE url = ?", (url,))
+            total_size -= size
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM responses")
+
+    def close(self):
+        self.connection.close()
+
+
+## shared by the CircleAPI GET endpoints, created on first use
+HTTP_CACHE = None
+
+
+def get_http_cache() -> HTTPCache:
+    global HTTP_CACHE
+    if HTTP_CACHE is None:
+        HTTP_CACHE = HTTPCache()
+    return HTTP_CACHE
+
+
+def configure_http_cache(
+    path=PATH_HTTP_CACHE,
+    ttl: float = HTTP_CACHE_TTL,
+    max_size: int = HTTP_CACHE_MAX_SIZE,
+):
+    """Replaces the shared cache, e.g. to change its ttl or size cap"""
+    global HTTP_CACHE
+    if HTTP_CACHE is not None:
+        HTTP_CACHE.close()
+    HTTP_CACHE = HTTPCache(path, ttl, max_size)
+
+
+def call_api_cached(url: str, use_cache: bool = True, **kwargs):
+    """
+    GETs url through the shared HTTPCache and returns the decoded JSON body.
+    Error responses are returned as they come and never cached.
+    """
+    if not use_cache:
+        return call_api(url, "get", **kwargs).json()
+    cache = get_http_cache()
+    entry = cache.get(url)
+    if entry is not None and cache.is_fresh(entry):
+        return json.loads(entry["body"])
+
+    headers = dict(kwargs.pop("headers", None) or {})
+    if entry is not None and entry["etag"] is not None:
+        headers["If-None-Match"] = entry["etag"]
+    if entry is not None and entry["last_modified"] is not None:
+        headers["If-Modified-Since"] = entry["last_modified"]
+    response = call_api(url, "get", headers=headers, **kwargs)
+    if response.status_code == 304 and entry is not None:
+        cache.refresh(url)
+        return json.loads(entry["body"])
+    if response.status_code == 200:
+        cache.store(url, response)
+    return response.json()
+
+
+def call_api_paginated(
+    url: str, max_workers: int = PAGES_MAX_WORKERS, use_cache: bool = False, **kwargs
+):
+    """
+    GETs url&page=1, url&page=2, ... until a page comes back empty, with up to
+    max_workers pages fetched ahead at the same time (through the shared
+    HTTPCache if use_cache).
+
+    Returns:
+    - list: The items of all the pages, in page order.
+    """
+
+    def get_page(page_num):
+        return call_api_cached(f"{url}&page={page_num}", use_cache, **kwargs)
+
+    max_workers = max(1, max_workers)
+    output = list()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {n: executor.submit(get_page, n) for n in range(1, max_workers + 1)}
+        next_page_num = max_workers + 1
+        page_num = 1
+        while True:
+            items = pending.pop(page_num).result()
+            if len(items) == 0:
+                break
+            output += items
+            pending[next_page_num] = executor.submit(get_page, next_page_num)
+            next_page_num += 1
+            page_num += 1
+        ## pages past the last one are empty: don't wait for those not started
+        for future in pending.values():
+            future.cancel()
+    return output
+
+
 class CircleAPI:
 
     CIRCLE_API_KEY = load_config()["circle"]["api_key"]
@@ -81,25 +390,33 @@ class CircleAPI:
 
     @classmethod
     def api_get_space_groups(
-        cls, community_id: Optional[int] = None, render: bool = True
+        cls,
+        community_id: Optional[int] = None,
+        render: bool = True,
+        use_cache: bool = True,
     ):
         if community_id is None:
             community_id = cls.ID_COMMUNITY_DIDASK
         url = f"{cls.CIRCLE_URL_SPACE_GROUPS}?community_id={community_id}"
-        response = call_api(url, "get", headers=cls.CIRCLE_HEADERS)
+        output = call_api_cached(url, use_cache, headers=cls.CIRCLE_HEADERS)
         if render:
-            render_json(response.json())
-        return response.json()
+            render_json(output)
+        return output
 
     @classmethod
-    def api_get_spaces(cls, community_id: Optional[int] = None, render: bool = True):
+    def api_get_spaces(
+        cls,
+        community_id: Optional[int] = None,
+        render: bool = True,
+        use_cache: bool = True,
+    ):
         if community_id is None:
             community_id = cls.ID_COMMUNITY_DIDASK
         url = f"{cls.CIRCLE_URL_SPACES}?community_id={community_id}"
-        response = call_api(url, "get", headers=cls.CIRCLE_HEADERS)
+        output = call_api_cached(url, use_cache, headers=cls.CIRCLE_HEADERS)
         if render:
-            render_json(response.json())
-        return response.json()
+            render_json(output)
+        return output
 
     @classmethod
     def api_get_posts(
@@ -108,24 +425,23 @@ class CircleAPI:
         space_id: Optional[int] = None,
         space_group_id: Optional[int] = None,
         render: bool = True,
+        max_workers: int = PAGES_MAX_WORKERS,
+        use_cache: bool = True,
     ):
         if community_id is None:
             community_id = cls.ID_COMMUNITY_DIDASK
         url = f"{cls.CIRCLE_URL_POSTS}?community_id={community_id}&per_page=100"
         if space_group_id is not None:
-            url += f"&space_group_id={space_id}"
+            url += f"&space_group_id={space_group_id}"
         if space_id is not None:
             url += f"&space_id={space_id}"
 
-        page_num = 1
-        output = list()
-        while True:
-            url_page = f"{url}&page={page_num}"
-            response = call_api(url_page, "get", headers=cls.CIRCLE_HEADERS)
-            if len(response.json()) == 0:
-                break
-            output += response.json()
-            page_num += 1
+        output = call_api_paginated(
+            url,
+            max_workers=max_workers,
+            use_cache=use_cache,
+            headers=cls.CIRCLE_HEADERS,
+        )
         if render:
             render_json(output)
         return output
@@ -156,23 +472,28 @@ class CircleAPI:
 
     @classmethod
     def api_get_course_sections(
-        cls, community_id: Optional[int] = None, render: bool = True
+        cls,
+        community_id: Optional[int] = None,
+        render: bool = True,
+        use_cache: bool = True,
     ):
         if community_id is None:
             community_id = cls.ID_COMMUNITY_DIDASK
         url = f"{cls.CIRCLE_URL_COURSE_SECTIONS}?community_id={community_id}"
-        response = call_api(url, "get", headers=cls.CIRCLE_HEADERS)
+        output = call_api_cached(url, use_cache, headers=cls.CIRCLE_HEADERS)
         if render:
-            render_json(response.json())
-        return response.json()
+            render_json(output)
+        return output
 
     @classmethod
-    def api_get_members(cls, render: bool = True):
+    def api_get_members(cls, render: bool = True, max_workers: int = PAGES_MAX_WORKERS):
         url = f"{cls.CIRCLE_URL_MEMBERS}?per_page=100"
-        response = call_api(url, "get", headers=cls.CIRCLE_HEADERS)
+        output = call_api_paginated(
+            url, max_workers=max_workers, headers=cls.CIRCLE_HEADERS
+        )
         if render:
-            render_json(response.json())
-        return response.json()
+            render_json(output)
+        return output
 
 
 class IntercomAPI:
@@ -198,25 +519,39 @@ class IntercomAPI:
         return l
 
     @classmethod
-    def api_get_collections(cls, render: bool = True):
-        url = f"{cls.INTERCOM_COLLECTIONS}"
+    def iter_pages(cls, url: str):
+        """Yields the list responses page by page, following pages.next"""
+        while url is not None:
+            response = call_api(url, "get", headers=cls.INTERCOM_HEADERS).json()
+            yield response
+            url = response["pages"].get("next", None)
 
-        response = call_api(url, "get", headers=cls.INTERCOM_HEADERS).json()
+    @classmethod
+    def get_all_pages(cls, url: str, key: str):
+        """All the items of a list endpoint, with the pagination info"""
+        pages = cls.iter_pages(url)
+        response = next(pages)
         res = {
             "type": response["type"],
-            "data": response["data"],
+            "data": cls.html_unescape(response["data"], key),
             "total_count": response["total_count"],
             "total_pages": response["pages"]["total_pages"],
             "per_page": response["pages"]["per_page"],
         }
-        while response["pages"].get("next", None) is not None:
-            new_url = response["pages"]["next"]
-            response = call_api(new_url, "get", headers=cls.INTERCOM_HEADERS).json()
-            res["data"] += response["data"]
+        for response in pages:
+            res["data"] += cls.html_unescape(response["data"], key)
+        return res
 
-        ## escape the collection name
-        res["data"] = IntercomAPI.html_unescape(res["data"], "name")
+    @classmethod
+    def iter_collections(cls):
+        """Yields the collections (name unescaped) as soon as their page arrives"""
+        for response in cls.iter_pages(f"{cls.INTERCOM_COLLECTIONS}"):
+            yield from cls.html_unescape(response["data"], "name")
 
+    @classmethod
+    def api_get_collections(cls, render: bool = True):
+        ## escape the collection name
+        res = cls.get_all_pages(f"{cls.INTERCOM_COLLECTIONS}", "name")
         if render:
             render_json(res)
         return res
@@ -242,6 +577,11 @@ class IntercomAPI:
             render_json(response.json())
         return response.json()
 
+    @classmethod
+    def api_delete(cls, url: str) -> int:
+        """DELETE without reading the response body: returns the status code"""
+        return call_api(url, "delete", headers=cls.INTERCOM_HEADERS).status_code
+
     @classmethod
     def api_get_admins(cls, render: bool = True):
         url = f"{cls.INTERCOM_ADMINS}"
@@ -267,24 +607,15 @@ class IntercomAPI:
         return response.json()
 
     @classmethod
-    def api_get_articles(cls, render: bool = True):
-        url = f"{cls.INTERCOM_ARTICLES}"
-        response = call_api(url, "get", headers=cls.INTERCOM_HEADERS).json()
-        res = {
-            "type": response["type"],
-            "data": response["data"],
-            "total_count": response["total_count"],
-            "total_pages": response["pages"]["total_pages"],
-            "per_page": response["pages"]["per_page"],
-        }
-        while response["pages"].get("next", None) is not None:
-            new_url = response["pages"]["next"]
-            response = call_api(new_url, "get", headers=cls.INTERCOM_HEADERS).json()
-            res["data"] += response["data"]
+    def iter_articles(cls):
+        """Yields the articles (title unescaped) as soon as their page arrives"""
+        for response in cls.iter_pages(f"{cls.INTERCOM_ARTICLES}"):
+            yield from cls.html_unescape(response["data"], "title")
 
+    @classmethod
+    def api_get_articles(cls, render: bool = True):
         ## escape the article title
-        res["data"] = IntercomAPI.html_unescape(res["data"], "title")
-
+        res = cls.get_all_pages(f"{cls.INTERCOM_ARTICLES}", "title")
         if render:
             render_json(res)
         return res
@@ -315,6 +646,33 @@ class IntercomAPI:
                 render_json(response.json())
             return response.json()
 
+    @classmethod
+    def api_update_article(
+        cls,
+        article_id: str,
+        title: str,
+        author_id: str,
+        body: Optional[str],
+        parent_id: Optional[str] = None,
+        state: str = "published",
+        render: bool = True,
+    ):
+        url = f"{cls.INTERCOM_ARTICLES}/{article_id}"
+        payload = {
+            "title": title,
+            "author_id": author_id,
+            "body": body,
+            "parent_id": parent_id,
+            "state": state,
+        }
+        response = call_api(url, "put", json=payload, headers=cls.INTERCOM_HEADERS)
+        if response.status_code != 200:
+            return response
+        else:
+            if render:
+                render_json(response.json())
+            return response.json()
+
     @classmethod
     def api_delete_article(cls, article_id: str, render: bool = True):
         url = f"{cls.INTERCOM_ARTICLES}/{article_id}"
@@ -0,0 +1,317 @@
+# asyncio counterparts of CircleAPI / IntercomAPI (same endpoints, same JSON shapes)
+# all calls go through one httpx.AsyncClient and one global concurrency limit, e.g.:
+#   articles = await asyncio.gather(*[AsyncIntercomAPI.api_create_article(...) ...])
+
+import asyncio
+from typing import Optional
+
+import httpx
+from api import (
+    HTTP_BACKOFF_FACTOR,
+    HTTP_IDEMPOTENT_METHODS,
+    HTTP_MAX_RETRIES,
+    HTTP_MAX_RETRY_DELAY,
+    HTTP_RETRY_STATUSES,
+    PAGES_MAX_WORKERS,
+    CircleAPI,
+    IntercomAPI,
+    get_rate_limit_delay,
+)
+from dev.utils import render_json
+
+ASYNC_MAX_CONCURRENCY = 10
+ASYNC_TIMEOUT = 30
+
+## the client and the semaphore belong to an event loop: one pair per loop
+ASYNC_CLIENTS = dict()
+
+
+def get_async_client(
+    max_concurrency: int = ASYNC_MAX_CONCURRENCY,
+) -> tuple[httpx.AsyncClient, asyncio.Semaphore]:
+    """Shared client and concurrency limit of the running event loop
+    max_concurrency only applies when they are created
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in ASYNC_CLIENTS:
+        limits = httpx.Limits(
+            max_connections=max_concurrency, max_keepalive_connections=max_concurrency
+        )
+        ASYNC_CLIENTS[loop] = (
+            httpx.AsyncClient(limits=limits, timeout=ASYNC_TIMEOUT),
+            asyncio.Semaphore(max_concurrency),
+        )
+    return ASYNC_CLIENTS[loop]
+
+
+async def close_async_client():
+    client, _ = ASYNC_CLIENTS.pop(asyncio.get_running_loop(), (None, None))
+    if client is not None:
+        await client.aclose()
+
+
+async def async_call_api(
+    url: str,
+    method: str,
+    max_retries: int = HTTP_MAX_RETRIES,
+    backoff_factor: float = HTTP_BACKOFF_FACTOR,
+    **kwargs,
+) -> httpx.Response:
+    """Async version of call_api: same retries, backoff and rate-limit handling.
+    At most ASYNC_MAX_CONCURRENCY requests are in flight at the same time.
+    """
+    client, semaphore = get_async_client()
+    is_idempotent = method.lower() in HTTP_IDEMPOTENT_METHODS
+    for attempt in range(max_retries + 1):
+        delay = min(backoff_factor * 2**attempt, HTTP_MAX_RETRY_DELAY)
+        try:
+            async with semaphore:
+                response = await client.request(method, url, **kwargs)
+        except httpx.TransportError as err:
+            print(f"Error during requests to {url}: {err}")
+            ## like call_api: a POST that may have been sent isn't sent again
+            never_sent = isinstance(err, httpx.ConnectTimeout)
+            if attempt == max_retries or not (is_idempotent or never_sent):
+                raise
+            await asyncio.sleep(delay)
+            continue
+
+        status = response.status_code
+        is_retryable = status == 429 or (
+            status in HTTP_RETRY_STATUSES and is_idempotent
+        )
+        if is_retryable and attempt < max_retries:
+            await asyncio.sleep(get_rate_limit_delay(response) or delay)
+            continue
+
+        try:
+            response.raise_for_status()
+        except httpx.HTTPStatusError as http_err:
+            print(f"HTTP error occurred: {http_err}")
+            return response
+
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            delay = get_rate_limit_delay(response) or 0
+            await asyncio.sleep(min(delay, HTTP_MAX_RETRY_DELAY))
+        return response
+
+
+async def async_call_api_paginated(
+    url: str, max_workers: int = PAGES_MAX_WORKERS, **kwargs
+) -> list:
+    """Async version of call_api_paginated: pages are requested max_workers at
+    a time until one comes back empty; returns the items in page order
+    """
+
+    async def get_page(page_num):
+        response = await async_call_api(f"{url}&page={page_num}", "get", **kwargs)
+        return response.json()
+
+    max_workers = max(1, max_workers)
+    output = list()
+    first_page_num = 1
+    while True:
+        page_nums = range(first_page_num, first_page_num + max_workers)
+        pages = await asyncio.gather(*[get_page(n) for n in page_nums])
+        for items in pages:
+            if len(items) == 0:
+                return output
+            output += items
+        first_page_num += max_workers
+
+
+class AsyncCircleAPI:
+
+    @classmethod
+    async def _get(cls, url: str, render: bool):
+        response = await async_call_api(url, "get", headers=CircleAPI.CIRCLE_HEADERS)
+        if render:
+            render_json(response.json())
+        return response.json()
+
+    @classmethod
+    async def api_get_me(cls, render: bool = True):
+        return await cls._get(f"{CircleAPI.CIRCLE_URL_ME}", render)
+
+    @classmethod
+    async def api_get_communities(cls, render: bool = True):
+        return await cls._get(f"{CircleAPI.CIRCLE_URL_COMMUNITY}", render)
+
+    @classmethod
+    async def api_get_space_groups(
+        cls, community_id: Optional[int] = None, render: bool = True
+    ):
+        if community_id is None:
+            community_id = CircleAPI.ID_COMMUNITY_DIDASK
+        url = f"{CircleAPI.CIRCLE_URL_SPACE_GROUPS}?community_id={community_id}"
+        return await cls._get(url, render)
+
+    @classmethod
+    async def api_get_spaces(
+        cls, community_id: Optional[int] = None, render: bool = True
+    ):
+        if community_id is None:
+            community_id = CircleAPI.ID_COMMUNITY_DIDASK
+        url = f"{CircleAPI.CIRCLE_URL_SPACES}?community_id={community_id}"
+        return await cls._get(url, render)
+
+    @classmethod
+    async def api_get_posts(
+        cls,
+        community_id: Optional[int] = None,
+        space_id: Optional[int] = None,
+        space_group_id: Optional[int] = None,
+        render: bool = True,
+        max_workers: int = PAGES_MAX_WORKERS,
+    ):
+        if community_id is None:
+            community_id = CircleAPI.ID_COMMUNITY_DIDASK
+        url = f"{CircleAPI.CIRCLE_URL_POSTS}?community_id={community_id}&per_page=100"
+        if space_group_id is not None:
+            url += f"&space_group_id={space_group_id}"
+        if space_id is not None:
+            url += f"&space_id={space_id}"
+
+        output = await async_call_api_paginated(
+            url, max_workers=max_workers, headers=CircleAPI.CIRCLE_HEADERS
+        )
+        if render:
+            render_json(output)
+        return output
+
+    @classmethod
+    async def api_get_course_lessons(
+        cls, community_id: Optional[int] = None, render: bool = True
+    ):
+        if community_id is None:
+            community_id = CircleAPI.ID_COMMUNITY_DIDASK
+        url = f"{CircleAPI.CIRCLE_URL_COURSE_LESSONS}?community_id={community_id}"
+        return await cls._get(url, render)
+
+    @classmethod
+    async def api_get_course_sections(
+        cls, community_id: Optional[int] = None, render: bool = True
+    ):
+        if community_id is None:
+            community_id = CircleAPI.ID_COMMUNITY_DIDASK
+        url = f"{CircleAPI.CIRCLE_URL_COURSE_SECTIONS}?community_id={community_id}"
+        return await cls._get(url, render)
+
+    @classmethod
+    async def api_get_members(
+        cls, render: bool = True, max_workers: int = PAGES_MAX_WORKERS
+    ):
+        url = f"{CircleAPI.CIRCLE_URL_MEMBERS}?per_page=100"
+        output = await async_call_api_paginated(
+            url, max_workers=max_workers, headers=CircleAPI.CIRCLE_HEADERS
+        )
+        if render:
+            render_json(output)
+        return output
+
+
+class AsyncIntercomAPI:
+
+    @classmethod
+    async def _call(cls, url: str, method: str, render: bool, **kwargs):
+        response = await async_call_api(
+            url, method, headers=IntercomAPI.INTERCOM_HEADERS, **kwargs
+        )
+        if render:
+            render_json(response.json())
+        return response.json()
+
+    @classmethod
+    async def _get_all_pages(cls, url: str, key: str, render: bool):
+        """First page, then all the other pages at once (total_pages is known)"""
+        response = await cls._call(url, "get", render=False)
+        res = {
+            "type": response["type"],
+            "data": response["data"],
+            "total_count": response["total_count"],
+            "total_pages": response["pages"]["total_pages"],
+            "per_page": response["pages"]["per_page"],
+        }
+        pages = await asyncio.gather(
+            *[
+                cls._call(f"{url}?page={n}&per_page={res['per_page']}", "get", False)
+                for n in range(2, res["total_pages"] + 1)
+            ]
+        )
+        for page in pages:
+            res["data"] += page["data"]
+
+        res["data"] = IntercomAPI.html_unescape(res["data"], key)
+        if render:
+            render_json(res)
+        return res
+
+    @classmethod
+    async def api_get_collections(cls, render: bool = True):
+        url = f"{IntercomAPI.INTERCOM_COLLECTIONS}"
+        return await cls._get_all_pages(url, "name", render)
+
+    @classmethod
+    async def api_create_collection(
+        cls, name: str, parent_id: Optional[int] = None, render: bool = True
+    ):
+        url = f"{IntercomAPI.INTERCOM_COLLECTIONS}"
+        payload = {"name": name}
+        if parent_id is not None:
+            payload["parent_id"] = parent_id
+        return await cls._call(url, "post", render, json=payload)
+
+    @classmethod
+    async def api_delete_collection(cls, coll_id: str, render: bool = True):
+        url = f"{IntercomAPI.INTERCOM_COLLECTIONS}/{coll_id}"
+        return await cls._call(url, "delete", render)
+
+    @classmethod
+    async def api_get_admins(cls, render: bool = True):
+        return await cls._call(f"{IntercomAPI.INTERCOM_ADMINS}", "get", render)
+
+    @classmethod
+    async def api_get_help_centers(cls, render: bool = True):
+        return await cls._call(f"{IntercomAPI.INTERCOM_HELP_CENTERS}", "get", render)
+
+    @classmethod
+    async def api_get_teams(cls, render: bool = True):
+        return await cls._call(f"{IntercomAPI.INTERCOM_TEAMS}", "get", render)
+
+    @classmethod
+    async def api_get_articles(cls, render: bool = True):
+        url = f"{IntercomAPI.INTERCOM_ARTICLES}"
+        return await cls._get_all_pages(url, "title", render)
+
+    @classmethod
+    async def api_create_article(
+        cls,
+        title: str,
+        author_id: str,
+        body: Optional[str],
+        parent_id: Optional[str] = None,
+        state: str = "published",
+        render: bool = True,
+    ):
+        url = f"{IntercomAPI.INTERCOM_ARTICLES}"
+        payload = {
+            "title": title,
+            "author_id": author_id,
+            "body": body,
+            "parent_id": parent_id,
+            "state": state,
+        }
+        response = await async_call_api(
+            url, "post", json=payload, headers=IntercomAPI.INTERCOM_HEADERS
+        )
+        if response.status_code != 200:
+            return response
+        else:
+            if render:
+                render_json(response.json())
+            return response.json()
+
+    @classmethod
+    async def api_delete_article(cls, article_id: str, render: bool = True):
+        url = f"{IntercomAPI.INTERCOM_ARTICLES}/{article_id}"
+        return await cls._call(url, "delete", render)
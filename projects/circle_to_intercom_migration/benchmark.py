@@ -0,0 +1,147 @@
+# times the migration steps against the local FakeAPIServer, e.g.:
+#   python benchmark.py --n-posts 1000 10000 --latency 0.05
+# to compare the throughput of pagination / concurrency changes offline
+
+import argparse
+import contextlib
+import io
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+from api import CircleAPI, IntercomAPI, configure_http_cache
+from fake_api_server import FakeAPIServer
+from migrate_circle_posts_to_intercom import MigrateCirclePostsToIntercom
+
+
+def time_step(server, results, step, func, *args, **kwargs):
+    """Runs func (its prints are swallowed) and appends its timing to results"""
+    server.reset_stats()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        output = func(*args, **kwargs)
+    duration = max(time.perf_counter() - start, 1e-9)
+    results.append(
+        {
+            "step": step,
+            "seconds": duration,
+            "calls": server.nb_requests,
+            "calls_per_s": server.nb_requests / duration,
+            "rate_limited": server.nb_rate_limited,
+        }
+    )
+    return output
+
+
+def run_benchmark(
+    n_posts: int,
+    latency: float = 0.05,
+    rate_limit_per_minute=None,
+    max_workers: int = 8,
+    pages_max_workers: int = 4,
+    rate_per_minute: float = 60_000,
+    serial: bool = True,
+) -> pd.DataFrame:
+    """Times each step of a full migration of n_posts fake posts
+    - serial: also time migrate_all_articles (one call at a time, slow)
+    """
+    results = list()
+    ## a fresh cache: the Circle reads are timed without it
+    configure_http_cache(Path(tempfile.mkdtemp()) / "http_cache.sqlite")
+    with FakeAPIServer(
+        n_posts=n_posts, latency=latency, rate_limit_per_minute=rate_limit_per_minute
+    ) as server:
+        posts = time_step(
+            server,
+            results,
+            "circle.api_get_posts",
+            CircleAPI.api_get_posts,
+            render=False,
+            max_workers=pages_max_workers,
+            use_cache=False,
+        )
+        migration = time_step(
+            server, results, "migration.__init__", MigrateCirclePostsToIntercom
+        )
+        time_step(
+            server,
+            results,
+            "migrate_all_collections",
+            migration.migrate_all_collections,
+            max_workers=max_workers,
+        )
+        if serial:
+            time_step(
+                server, results, "migrate_all_articles", migration.migrate_all_articles
+            )
+            server.reset_intercom()
+            migration = MigrateCirclePostsToIntercom()
+            migration.migrate_all_collections(max_workers=max_workers)
+        time_step(
+            server,
+            results,
+            "migrate_all_articles_concurrently",
+            migration.migrate_all_articles_concurrently,
+            posts,
+            max_workers=max_workers,
+            rate_per_minute=rate_per_minute,
+        )
+        time_step(
+            server,
+            results,
+            "intercom.api_get_collections",
+            IntercomAPI.api_get_collections,
+            render=False,
+        )
+        time_step(
+            server,
+            results,
+            "intercom.api_get_articles",
+            IntercomAPI.api_get_articles,
+            render=False,
+        )
+        time_step(
+            server,
+            results,
+            "delete_all_intercom_articles",
+            MigrateCirclePostsToIntercom.delete_all_intercom_articles,
+            are_you_sure=True,
+            display_progress=False,
+            max_workers=max_workers,
+            rate_per_minute=rate_per_minute,
+        )
+
+    df = pd.DataFrame(results)
+    df.insert(0, "n_posts", n_posts)
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-posts", type=int, nargs="+", default=[1000, 10_000])
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--rate-limit-per-minute", type=int, default=None)
+    parser.add_argument("--max-workers", type=int, default=8)
+    parser.add_argument("--pages-max-workers", type=int, default=4)
+    parser.add_argument("--no-serial", action="store_true")
+    args = parser.parse_args()
+
+    df = pd.concat(
+        [
+            run_benchmark(
+                n,
+                latency=args.latency,
+                rate_limit_per_minute=args.rate_limit_per_minute,
+                max_workers=args.max_workers,
+                pages_max_workers=args.pages_max_workers,
+                serial=not args.no_serial,
+            )
+            for n in args.n_posts
+        ]
+    )
+    print(df.to_string(index=False, float_format="{:.2f}".format))
+
+
+if __name__ == "__main__":
+    main()
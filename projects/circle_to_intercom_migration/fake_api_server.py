@@ -0,0 +1,346 @@
+# local stand-in for the Circle and Intercom APIs, to run / measure the migration
+# offline. Serves the endpoints used by CircleAPI and IntercomAPI (same JSON shapes),
+# with a configurable latency and Intercom-like rate limiting, e.g.:
+#   with FakeAPIServer(n_posts=1000, latency=0.05) as server:
+#       MigrateCirclePostsToIntercom().migrate_all_collections()
+
+import hashlib
+import html
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+from api import CircleAPI, IntercomAPI
+
+CIRCLE_PER_PAGE = 100
+INTERCOM_PER_PAGE = 50
+## Intercom counts the calls over windows of 10 seconds
+RATE_LIMIT_WINDOW = 10
+ADMIN_NAMES = ["Support technique", "Alice Martin", "Bruno Petit", "Chloé Durand"]
+
+
+### fake data
+def build_fake_community(
+    n_posts: int,
+    n_space_groups: int = 10,
+    spaces_per_group: int = 5,
+    body_size: int = 2000,
+    seed: int = 0,
+) -> dict:
+    """Circle space groups, spaces and posts shaped like the API responses"""
+    rng = random.Random(seed)
+    space_groups = [
+        {"id": 1000 + i, "name": f"Space group {i}"} for i in range(n_space_groups)
+    ]
+    spaces = [
+        {
+            "id": 2000 + i * spaces_per_group + j,
+            ## the same space names are used in every group, like on Circle
+            "name": f"Space {j}",
+            "space_group_id": g["id"],
+            "space_group_name": g["name"],
+        }
+        for (i, g) in enumerate(space_groups)
+        for j in range(spaces_per_group)
+    ]
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "élève", "cours", "&amp;"]
+    updated_at = datetime(2024, 1, 1)
+    posts = list()
+    for i in range(n_posts):
+        space = rng.choice(spaces)
+        text = " ".join(rng.choice(words) for _ in range(body_size // 6))
+        posts.append(
+            {
+                "id": 10_000 + i,
+                "name": f"Post {i} & co",
+                "body": {"body": f"<div><h2>Post {i}</h2><p>{text}</p></div>"},
+                "user_name": rng.choice(ADMIN_NAMES + ["Former member"]),
+                "space_id": space["id"],
+                "space_name": space["name"],
+                "space_group_id": space["space_group_id"],
+                "updated_at": (updated_at + timedelta(minutes=i)).isoformat(),
+            }
+        )
+    return {"space_groups": space_groups, "spaces": spaces, "posts": posts}
+
+
+### server
+class FakeAPIServer:
+    """Serves a fake Circle community and an in-memory Intercom help center.
+    - latency: seconds added to every response (+/- jitter, as a fraction)
+    - rate_limit_per_minute: Intercom-like quota on all the calls; the
+      X-RateLimit-* headers are sent, and a 429 once the quota is used up
+    While started, CircleAPI / IntercomAPI point to it.
+    """
+
+    def __init__(
+        self,
+        n_posts: int = 1000,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        rate_limit_per_minute: Optional[int] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        **community_kwargs,
+    ):
+        self.community = build_fake_community(n_posts, **community_kwargs)
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_per_minute = rate_limit_per_minute
+        self.lock = threading.Lock()
+        self.reset_intercom()
+        self.reset_stats()
+        self.httpd = ThreadingHTTPServer((host, port), self.build_handler())
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_port}"
+        self.thread = None
+        self.patched_urls = dict()
+
+    def reset_intercom(self):
+        """Empties the help center (keeps the admins)"""
+        with self.lock:
+            self.admins = [
+                {"type": "admin", "id": str(100 + i), "name": name}
+                for (i, name) in enumerate(ADMIN_NAMES)
+            ]
+            self.collections = dict()
+            self.articles = dict()
+            self.next_id = 1
+
+    def reset_stats(self):
+        with self.lock:
+            self.nb_requests = 0
+            self.nb_rate_limited = 0
+            self.window_start = time.time()
+            self.window_calls = 0
+
+    ## rate limiting
+    def take_quota(self) -> tuple[bool, dict]:
+        """(allowed, X-RateLimit-* headers) for a new call"""
+        if self.rate_limit_per_minute is None:
+            return True, dict()
+        limit = max(1, self.rate_limit_per_minute * RATE_LIMIT_WINDOW // 60)
+        with self.lock:
+            now = time.time()
+            if now - self.window_start >= RATE_LIMIT_WINDOW:
+                self.window_start = now
+                self.window_calls = 0
+            allowed = self.window_calls < limit
+            if allowed:
+                self.window_calls += 1
+            else:
+                self.nb_rate_limited += 1
+            headers = {
+                "X-RateLimit-Limit": str(limit),
+                "X-RateLimit-Remaining": str(limit - self.window_calls),
+                "X-RateLimit-Reset": str(int(self.window_start + RATE_LIMIT_WINDOW)),
+            }
+        return allowed, headers
+
+    ## Circle
+    def circle_get(self, path: str, query: dict):
+        resource = path.removeprefix("/circle/api/v1/")
+        if resource == "me":
+            return {"id": 1, "name": "Fake admin"}
+        if resource == "communities":
+            return [{"id": CircleAPI.ID_COMMUNITY_DIDASK, "name": "Fake community"}]
+        if resource in ["space_groups", "spaces"]:
+            return self.community[resource]
+        if resource in ["course_lessons", "course_sections"]:
+            return list()
+        if resource in ["posts", "community_members"]:
+            if resource == "posts":
+                items = self.community["posts"]
+                for key in ["space_id", "space_group_id"]:
+                    if key in query:
+                        items = [p for p in items if str(p[key]) == query[key]]
+            else:
+                items = [
+                    {"id": i, "name": name} for (i, name) in enumerate(ADMIN_NAMES)
+                ]
+            per_page = int(query.get("per_page", CIRCLE_PER_PAGE))
+            page = int(query.get("page", 1))
+            return items[(page - 1) * per_page : page * per_page]
+        return None
+
+    ## Intercom
+    def intercom_list(self, path: str, items: list, query: dict):
+        per_page = int(query.get("per_page", INTERCOM_PER_PAGE))
+        page = int(query.get("page", 1))
+        total_pages = max(1, -(-len(items) // per_page))
+        next_url = None
+        if page < total_pages:
+            next_url = f"{self.url}{path}?page={page + 1}&per_page={per_page}"
+        return {
+            "type": "list",
+            "data": items[(page - 1) * per_page : page * per_page],
+            "total_count": len(items),
+            "pages": {
+                "type": "pages",
+                "page": page,
+                "per_page": per_page,
+                "total_pages": total_pages,
+                "next": next_url,
+            },
+        }
+
+    def intercom_call(self, method: str, path: str, query: dict, payload: dict):
+        """(status code, JSON body) of an Intercom call"""
+        match = re.fullmatch(r"/intercom(/[a-z_/]+?)(?:/(\d+))?", path)
+        if match is None:
+            return 404, {"type": "error.list"}
+        resource, object_id = match.groups()
+        store = {
+            "/help_center/collections": self.collections,
+            "/articles": self.articles,
+        }.get(resource)
+        with self.lock:
+            if resource == "/admins" and method == "GET":
+                return 200, {"type": "admin.list", "admins": self.admins}
+            if store is None:
+                return 404, {"type": "error.list"}
+            if object_id is None and method == "GET":
+                items = [dict(obj) for obj in store.values()]
+                return 200, self.intercom_list(path, items, query)
+            if object_id is None and method == "POST":
+                obj = self.create_intercom_object(resource, payload)
+                store[obj["id"]] = obj
+                return 200, obj
+            if object_id not in store:
+                return 404, {"type": "error.list"}
+            if method == "PUT":
+                store[object_id] |= self.escape_names(payload)
+                return 200, store[object_id]
+            if method == "DELETE":
+                obj = store.pop(object_id)
+                return 200, {"id": object_id, "object": obj["type"], "deleted": True}
+        return 405, {"type": "error.list"}
+
+    @staticmethod
+    def escape_names(payload: dict) -> dict:
+        ## Intercom returns the names / titles HTML-escaped
+        return payload | {
+            k: html.escape(payload[k], quote=False)
+            for k in ["name", "title"]
+            if k in payload
+        }
+
+    def create_intercom_object(self, resource: str, payload: dict) -> dict:
+        ## called with the lock held
+        obj = {"id": str(self.next_id)} | self.escape_names(payload)
+        self.next_id += 1
+        if resource == "/help_center/collections":
+            obj.setdefault("parent_id", None)
+            obj["type"] = "collection"
+        else:
+            obj["type"] = "article"
+        return obj
+
+    def build_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            ## keep-alive, like the real APIs
+            protocol_version = "HTTP/1.1"
+            ## headers and body are sent separately: don't wait for the ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status: int, obj, headers: dict):
+                body = json.dumps(obj).encode("utf-8")
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def handle_call(self):
+                with server.lock:
+                    server.nb_requests += 1
+                if server.latency > 0:
+                    jitter = server.latency * server.jitter
+                    time.sleep(
+                        max(0.0, server.latency + random.uniform(-jitter, jitter))
+                    )
+                length = int(self.headers.get("Content-Length") or 0)
+                payload = json.loads(self.rfile.read(length)) if length else dict()
+                url = urlsplit(self.path)
+                query = {k: v[0] for (k, v) in parse_qs(url.query).items()}
+
+                allowed, headers = server.take_quota()
+                if not allowed:
+                    return self.send_json(429, {"type": "error.list"}, headers)
+
+                if url.path.startswith("/circle/") and self.command == "GET":
+                    obj = server.circle_get(url.path, query)
+                    if obj is None:
+                        return self.send_json(404, {"status": "not found"}, headers)
+                    ## Circle-like validators, for the conditional GETs
+                    etag = hashlib.sha256(json.dumps(obj).encode()).hexdigest()
+                    headers["ETag"] = f'"{etag}"'
+                    if self.headers.get("If-None-Match") == headers["ETag"]:
+                        self.send_response(304)
+                        for key, value in headers.items():
+                            self.send_header(key, value)
+                        self.send_header("Content-Length", "0")
+                        return self.end_headers()
+                    return self.send_json(200, obj, headers)
+
+                if url.path.startswith("/intercom/"):
+                    status, obj = server.intercom_call(
+                        self.command, url.path, query, payload
+                    )
+                    return self.send_json(status, obj, headers)
+                return self.send_json(404, {"status": "not found"}, headers)
+
+            do_GET = do_POST = do_PUT = do_DELETE = handle_call
+
+        return Handler
+
+    ## lifecycle
+    def patch_apis(self):
+        """Points the URLs of CircleAPI / IntercomAPI to the server"""
+        circle_root = f"{self.url}/circle/api/v1"
+        intercom_root = f"{self.url}/intercom"
+        for cls, old_root, new_root in [
+            (CircleAPI, CircleAPI.CIRCLE_URL_ROOT, circle_root),
+            (IntercomAPI, IntercomAPI.INTERCOM_API_ROOT, intercom_root),
+        ]:
+            for name, value in vars(cls).items():
+                if isinstance(value, str) and value.startswith(old_root):
+                    self.patched_urls[(cls, name)] = value
+            for (c, name), value in self.patched_urls.items():
+                if c is cls:
+                    setattr(cls, name, new_root + value.removeprefix(old_root))
+
+    def unpatch_apis(self):
+        for (cls, name), value in self.patched_urls.items():
+            setattr(cls, name, value)
+        self.patched_urls = dict()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        self.patch_apis()
+        return self
+
+    def stop(self):
+        self.unpatch_apis()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -0,0 +1,119 @@
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+PATH_MIGRATION_JOURNAL = Path(__file__).parent / "migration_journal.sqlite"
+
+## kinds of migrated objects: Circle space groups and spaces become Intercom
+## collections, Circle posts become Intercom articles
+KIND_SPACE_GROUP = "space_group"
+KIND_SPACE = "space"
+KIND_POST = "post"
+
+
+class MigrationJournal:
+    """Checkpoints of a migration: maps each migrated Circle object (kind, id)
+    to the Intercom object created for it, so that a re-run skips what is done.
+    Each record is committed right away: a crash loses at most the calls in flight.
+    """
+
+    def __init__(self, path=PATH_MIGRATION_JOURNAL):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS migrated (
+                    kind TEXT NOT NULL,
+                    circle_id TEXT NOT NULL,
+                    intercom_id TEXT NOT NULL,
+                    migrated_at TEXT NOT NULL,
+                    PRIMARY KEY (kind, circle_id)
+                )""")
+            ## state of the Circle object when it was last pushed (for syncs)
+            columns = [
+                row[1] for row in self.connection.execute("PRAGMA table_info(migrated)")
+            ]
+            for column in ["circle_updated_at", "content_hash"]:
+                if column not in columns:
+                    self.connection.execute(
+                        f"ALTER TABLE migrated ADD COLUMN {column} TEXT"
+                    )
+
+    def get(self, kind: str, circle_id) -> Optional[str]:
+        """Intercom id created for a Circle object (None if not migrated yet)"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT intercom_id FROM migrated WHERE kind = ? AND circle_id = ?",
+                (kind, str(circle_id)),
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def get_all(self, kind: str) -> dict:
+        """{circle_id: intercom_id} for all migrated objects of a kind"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT circle_id, intercom_id FROM migrated WHERE kind = ?", (kind,)
+            ).fetchall()
+        return dict(rows)
+
+    def get_states(self, kind: str) -> dict:
+        """{circle_id: {"intercom_id", "circle_updated_at", "content_hash"}}"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT circle_id, intercom_id, circle_updated_at, content_hash"
+                " FROM migrated WHERE kind = ?",
+                (kind,),
+            ).fetchall()
+        return {
+            circle_id: {
+                "intercom_id": intercom_id,
+                "circle_updated_at": circle_updated_at,
+                "content_hash": content_hash,
+            }
+            for (circle_id, intercom_id, circle_updated_at, content_hash) in rows
+        }
+
+    def record(
+        self,
+        kind: str,
+        circle_id,
+        intercom_id,
+        circle_updated_at: Optional[str] = None,
+        content_hash: Optional[str] = None,
+    ):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO migrated (kind, circle_id, intercom_id,"
+                " migrated_at, circle_updated_at, content_hash)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    kind,
+                    str(circle_id),
+                    str(intercom_id),
+                    datetime.now().isoformat(),
+                    circle_updated_at,
+                    content_hash,
+                ),
+            )
+
+    def delete(self, kind: str, circle_id):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM migrated WHERE kind = ? AND circle_id = ?",
+                (kind, str(circle_id)),
+            )
+
+    def clear(self, kind: Optional[str] = None):
+        """Forgets the migrated objects (of a kind, or all), e.g. after deleting
+        everything on Intercom
+        """
+        with self.lock, self.connection:
+            if kind is None:
+                self.connection.execute("DELETE FROM migrated")
+            else:
+                self.connection.execute("DELETE FROM migrated WHERE kind = ?", (kind,))
+
+    def close(self):
+        self.connection.close()
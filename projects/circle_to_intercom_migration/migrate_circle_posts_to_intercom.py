@@ -1,146 +1,337 @@
-import html
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 import pandas as pd
-from api_circle import CircleAPI
-from api_intercom import IntercomAPI
+from api import CircleAPI, IntercomAPI, TokenBucket
+from journal import KIND_POST, KIND_SPACE, KIND_SPACE_GROUP, MigrationJournal
 from tqdm import tqdm
 
 
 class MigrateCirclePostsToIntercom:
 
     DEFAULT_INTERCOM_AUTHOR = "Support technique"
+    ## Intercom allows 10,000 calls per minute per app: stay well below
+    INTERCOM_RATE_PER_MINUTE = 1000
 
-    def __init__(self):
-        self.space_groups = CircleAPI.api_get_space_groups(render=False)
-        self.spaces = CircleAPI.api_get_spaces(render=False)
-        self.df_collections_lookup = (
-            pd.DataFrame(
-                {
-                    "name": [s["name"] for s in self.space_groups]
-                    + [s["name"] for s in self.spaces],
-                    "parent_name": [None] * len(self.space_groups)
-                    + [s["space_group_name"] for s in self.spaces],
-                    "circle_id": [s["id"] for s in self.space_groups]
-                    + [str(s["id"]) for s in self.spaces],
-                    "circle_parent_id": [None] * len(self.space_groups)
-                    + [str(s["space_group_id"]) for s in self.spaces],
-                    "intercom_id": None,
-                    "intercom_parent_id": None,
-                }
-            )
-            .sort_values("parent_name", ascending=True, na_position="first")
-            .set_index("name")
+    def __init__(self, journal: Optional[MigrationJournal] = None, use_cache=True):
+        ## with a journal, re-runs skip the collections / articles already migrated
+        self.journal = journal
+        self.load_collections(use_cache)
+
+    def load_collections(self, use_cache=True):
+        """(Re)reads the Circle space groups / spaces and finds their collection"""
+        self.space_groups = CircleAPI.api_get_space_groups(
+            render=False, use_cache=use_cache
         )
+        self.spaces = CircleAPI.api_get_spaces(render=False, use_cache=use_cache)
+
+        ## collection tree: one node per Circle space group / space, keyed by
+        ## (kind, circle id) since a space group and a space can share an id
+        self.collections = dict()
+        for s in self.space_groups:
+            self.collections[(KIND_SPACE_GROUP, str(s["id"]))] = {
+                "name": s["name"],
+                "kind": KIND_SPACE_GROUP,
+                "circle_id": str(s["id"]),
+                "parent_key": None,
+                "intercom_id": None,
+            }
+        for s in self.spaces:
+            self.collections[(KIND_SPACE, str(s["id"]))] = {
+                "name": s["name"],
+                "kind": KIND_SPACE,
+                "circle_id": str(s["id"]),
+                "parent_key": (KIND_SPACE_GROUP, str(s["space_group_id"])),
+                "intercom_id": None,
+            }
 
         self.find_intercom_id_for_collections()
 
+    @property
+    def df_collections_lookup(self):
+        """The collection tree as a table, with the intercom id of each parent"""
+        df = pd.DataFrame(
+            [{"circle_key": k} | node for (k, node) in self.collections.items()]
+        )
+        parents = df[["circle_key", "intercom_id"]].rename(
+            columns={"circle_key": "parent_key", "intercom_id": "intercom_parent_id"}
+        )
+        return df.merge(parents, on="parent_key", how="left")
+
+    def get_intercom_parent_id(self, key):
+        parent_key = self.collections[key]["parent_key"]
+        if parent_key not in self.collections:
+            return None
+        return self.collections[parent_key]["intercom_id"]
+
+    def get_collection_levels(self):
+        """Collection keys grouped by depth: roots first, then their children, ..."""
+        depths = dict()
+
+        def get_depth(key):
+            if key not in depths:
+                parent_key = self.collections[key]["parent_key"]
+                depths[key] = (
+                    get_depth(parent_key) + 1 if parent_key in self.collections else 0
+                )
+            return depths[key]
+
+        levels = list()
+        for key in self.collections:
+            depth = get_depth(key)
+            while len(levels) <= depth:
+                levels.append(list())
+            levels[depth].append(key)
+        return levels
+
     def find_intercom_id_for_collections(self):
+        ## the journal knows the collection of each migrated space (group), even
+        ## if it was renamed on Circle since
+        for node in self.collections.values():
+            node["intercom_id"] = self.get_migrated_id(node["kind"], node["circle_id"])
+        if all(node["intercom_id"] is not None for node in self.collections.values()):
+            return
+
+        ## else existing collections by (name, parent): the same name can be used
+        ## under several parents
         colls = IntercomAPI.api_get_collections(render=False)["data"]
-        colls_name = [
-            c["name"] for c in colls if c["name"] in self.df_collections_lookup.index
-        ]
-        colls_idx = [
-            c["id"] for c in colls if c["name"] in self.df_collections_lookup.index
-        ]
-
-        ## set intercom id
-        self.df_collections_lookup.loc[colls_name, "intercom_id"] = colls_idx
-
-        ## set intercom parent id
-        for i in range(len(self.df_collections_lookup)):
-            coll_name = self.df_collections_lookup.index[i]
-            parent_name = self.df_collections_lookup.iloc[i]["parent_name"]
-            if parent_name is not None:
-                self.df_collections_lookup.loc[coll_name, "intercom_parent_id"] = (
-                    self.df_collections_lookup.loc[parent_name, "intercom_id"]
-                )
+        intercom_ids = {
+            (c["name"], str(c["parent_id"]) if c["parent_id"] is not None else None): (
+                c["id"]
+            )
+            for c in colls
+        }
+        for level in self.get_collection_levels():
+            for key in level:
+                node = self.collections[key]
+                if node["intercom_id"] is not None:
+                    continue
+                parent_id = self.get_intercom_parent_id(key)
+                if parent_id is None and node["parent_key"] in self.collections:
+                    continue
+                parent_id = str(parent_id) if parent_id is not None else None
+                node["intercom_id"] = intercom_ids.get((node["name"], parent_id))
 
     @classmethod
-    def delete_all_intercom_collections(
-        cls, are_you_sure: bool = False, display_progress: bool = True
+    def bulk_delete(
+        cls,
+        url_root: str,
+        ids,
+        are_you_sure: bool = False,
+        max_workers: int = 8,
+        rate_per_minute: float = INTERCOM_RATE_PER_MINUTE,
+        display_progress: bool = True,
     ):
+        """DELETEs url_root/<id> for each id, with up to max_workers calls at once,
+        paced by a token bucket at rate_per_minute (429s are retried by call_api).
+        ids can be a generator: each id is deleted as soon as it comes, so that
+        deletion starts while the listing is still going.
+        Returns one result per id, in the same order: {"id", "status", "latency"}
+        """
         if not are_you_sure:
             raise ValueError('You have to set "are_you_sure" to True')
-        collections_id = [
-            e["id"]
-            for e in IntercomAPI.api_get_collections(render=False)["data"]
-            if e["parent_id"] is None
-        ]
+        bucket = TokenBucket(rate_per_minute)
+        ## don't take ids further ahead than the deletions can follow
+        slots = threading.BoundedSemaphore(max_workers)
+
+        def delete(object_id):
+            bucket.acquire()
+            start = time.perf_counter()
+            try:
+                status = IntercomAPI.api_delete(f"{url_root}/{object_id}")
+            except Exception as e:
+                status = f"error: {e}"
+            finally:
+                slots.release()
+            return {
+                "id": object_id,
+                "status": status,
+                "latency": time.perf_counter() - start,
+            }
+
         if display_progress:
-            collections_id = tqdm(collections_id)
-        for coll_id in collections_id:
-            IntercomAPI.api_delete_collection(coll_id=coll_id, render=False)
+            ids = tqdm(ids)
+        start = time.perf_counter()
+        futures = list()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for object_id in ids:
+                slots.acquire()
+                futures.append(executor.submit(delete, object_id))
+        res = [f.result() for f in futures]
+        duration = max(time.perf_counter() - start, 1e-9)
+
+        nb_deleted = sum(r["status"] == 200 for r in res)
+        print(
+            f"{nb_deleted}/{len(res)} deleted in {duration:.1f}s"
+            f" ({len(res) / duration:.1f} calls/s)"
+        )
+        return res
+
+    @classmethod
+    def delete_all(cls, url_root: str, iter_ids, **kwargs):
+        """bulk_delete of the ids listed by iter_ids(), listing again until
+        nothing is left: deleting shifts the next pages, so one pass misses some.
+        Stops when a pass deletes nothing (e.g. all deletions fail).
+        Returns {id: last result}
+        """
+        res = dict()
+        while True:
+            pass_res = cls.bulk_delete(url_root, iter_ids(), **kwargs)
+            res |= {r["id"]: r for r in pass_res}
+            if not any(r["status"] == 200 for r in pass_res):
+                return res
+
+    @classmethod
+    def delete_all_intercom_collections(cls, are_you_sure: bool = False, **kwargs):
+        """Deletes the root collections (with their sub-collections);
+        kwargs are passed to bulk_delete
+        """
+
+        def iter_ids():
+            for e in IntercomAPI.iter_collections():
+                if e["parent_id"] is None:
+                    yield e["id"]
+
+        return cls.delete_all(
+            IntercomAPI.INTERCOM_COLLECTIONS,
+            iter_ids,
+            are_you_sure=are_you_sure,
+            **kwargs,
+        )
 
     @classmethod
-    def delete_all_intercom_articles(
-        cls, are_you_sure: bool = False, display_progress: bool = True
+    def delete_all_intercom_articles(cls, are_you_sure: bool = False, **kwargs):
+        """kwargs are passed to bulk_delete"""
+
+        def iter_ids():
+            for e in IntercomAPI.iter_articles():
+                yield e["id"]
+
+        return cls.delete_all(
+            IntercomAPI.INTERCOM_ARTICLES, iter_ids, are_you_sure=are_you_sure, **kwargs
+        )
+
+    def get_migrated_id(self, kind, circle_id):
+        if self.journal is None:
+            return None
+        return self.journal.get(kind, circle_id)
+
+    def record_migrated_id(self, kind, circle_id, intercom_id):
+        if self.journal is not None:
+            self.journal.record(kind, circle_id, intercom_id)
+
+    def record_migrated_post(self, p, intercom_id, article):
+        ## keep the post state, so that sync_articles can tell if it changed
+        if self.journal is not None:
+            self.journal.record(
+                KIND_POST,
+                p["id"],
+                intercom_id,
+                circle_updated_at=p.get("updated_at"),
+                content_hash=self.hash_article(article),
+            )
+
+    def migrate_collections(
+        self,
+        keys,
+        max_workers: int = 1,
+        rate_per_minute: float = INTERCOM_RATE_PER_MINUTE,
     ):
-        if not are_you_sure:
-            raise ValueError('You have to set "are_you_sure" to True')
-        articles_id = [
-            e["id"] for e in IntercomAPI.api_get_articles(render=False)["data"]
-        ]
-        if display_progress:
-            articles_id = tqdm(articles_id)
-        for a_id in articles_id:
-            IntercomAPI.api_delete_article(article_id=a_id, render=False)
-
-    def migrate_root_collections(self):
-        root_collections = self.df_collections_lookup.index[
-            self.df_collections_lookup["parent_name"].apply(lambda x: x is None)
-        ]
-        intercom_collections_created = [
-            IntercomAPI.api_create_collection(n, render=False) for n in root_collections
-        ]
-
-        ## add intercom IDs to lookup table
-        idx = [html.unescape(e["name"]) for e in intercom_collections_created]
-        intercom_id = [e["id"] for e in intercom_collections_created]
-        self.df_collections_lookup.loc[idx, "intercom_id"] = intercom_id
-
-        ## add parent ID for intercom sub collections
-        for i in range(len(self.df_collections_lookup)):
-            coll_name = self.df_collections_lookup.index[i]
-            parent_name = self.df_collections_lookup.iloc[i]["parent_name"]
-            if parent_name is not None:
-                self.df_collections_lookup.loc[coll_name, "intercom_parent_id"] = (
-                    self.df_collections_lookup.loc[parent_name, "intercom_id"]
+        """Creates the Intercom collections of keys (their parents must already
+        exist), with up to max_workers calls at once
+        """
+        bucket = TokenBucket(rate_per_minute)
+
+        def migrate_collection(key):
+            node = self.collections[key]
+            intercom_id = self.get_migrated_id(node["kind"], node["circle_id"])
+            if intercom_id is not None:
+                node["intercom_id"] = intercom_id
+                return None
+            if node["intercom_id"] is not None:
+                ## found on Intercom by name: journal it instead of creating it
+                self.record_migrated_id(
+                    node["kind"], node["circle_id"], node["intercom_id"]
                 )
-        return intercom_collections_created
-
-    def migrate_sub_collections(self):
-        ## create sub collections
-        sub_collections_name = self.df_collections_lookup.index[
-            self.df_collections_lookup["parent_name"].apply(lambda x: x is not None)
-        ]
-        sub_collections_parent_id = self.df_collections_lookup.loc[
-            sub_collections_name, "intercom_parent_id"
-        ]
-        intercom_sub_collections_created = [
-            IntercomAPI.api_create_collection(name=n, parent_id=i, render=False)
-            for (n, i) in sub_collections_parent_id.items()
-        ]
-
-        ## add intercom ID
-        for e in intercom_sub_collections_created:
-            self.df_collections_lookup.loc[html.unescape(e["name"]), "intercom_id"] = e[
-                "id"
-            ]
+                return None
+            bucket.acquire()
+            e = IntercomAPI.api_create_collection(
+                name=node["name"],
+                parent_id=self.get_intercom_parent_id(key),
+                render=False,
+            )
+            node["intercom_id"] = e["id"]
+            self.record_migrated_id(node["kind"], node["circle_id"], e["id"])
+            return e
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            created = list(executor.map(migrate_collection, keys))
+        return [e for e in created if e is not None]
+
+    def migrate_root_collections(self, max_workers: int = 1):
+        return self.migrate_collections(self.get_collection_levels()[0], max_workers)
+
+    def migrate_sub_collections(self, max_workers: int = 1):
+        ## level by level, so that parents exist before their children
+        intercom_sub_collections_created = list()
+        for level in self.get_collection_levels()[1:]:
+            intercom_sub_collections_created += self.migrate_collections(
+                level, max_workers
+            )
         return intercom_sub_collections_created
 
-    def migrate_all_collections(self):
-        out1 = self.migrate_root_collections()
-        out2 = self.migrate_sub_collections()
+    def migrate_all_collections(self, max_workers: int = 1):
+        out1 = self.migrate_root_collections(max_workers)
+        out2 = self.migrate_sub_collections(max_workers)
         out = out1 + out2
         return out
 
-    def migrate_all_articles(self, display_progress=False):
-
-        ## get intercom admin IDs (authors are admins)
+    @staticmethod
+    def get_intercom_admins_id_lookup():
+        ## intercom admin IDs (authors are admins)
         intercom_admins = IntercomAPI.api_get_admins(render=False)["admins"]
-        intercom_admins_id_lookup = {
-            admin["name"]: admin["id"] for admin in intercom_admins
-        }
+        return {admin["name"]: admin["id"] for admin in intercom_admins}
+
+    def get_article_parent_id(self, p):
+        """Intercom collection of the space of a Circle post
+        raises ValueError if the space has no collection (yet): an article sent
+        with parent_id=None would end up out of any collection
+        """
+        node = self.collections.get((KIND_SPACE, str(p["space_id"])))
+        if node is None or node["intercom_id"] is None:
+            raise ValueError(
+                f"no Intercom collection for the space {p['space_id']}"
+                f" of the post {p['id']}"
+            )
+        return node["intercom_id"]
+
+    def build_article(self, p, intercom_admins_id_lookup):
+        """Arguments of api_create_article for a Circle post"""
+        return dict(
+            title=p["name"],
+            body=p["body"]["body"],
+            author_id=intercom_admins_id_lookup.get(
+                p["user_name"],
+                intercom_admins_id_lookup[self.DEFAULT_INTERCOM_AUTHOR],
+            ),
+            state="published",
+            parent_id=self.get_article_parent_id(p),
+            render=False,
+        )
+
+    @staticmethod
+    def hash_article(article):
+        content = {k: article[k] for k in ["title", "body", "author_id", "parent_id"]}
+        return hashlib.sha256(
+            json.dumps(content, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    def migrate_all_articles(self, display_progress=False):
+        intercom_admins_id_lookup = self.get_intercom_admins_id_lookup()
 
         ## get Circle posts
         posts = CircleAPI.api_get_posts(render=False)
@@ -148,19 +339,172 @@ class MigrateCirclePostsToIntercom:
         if display_progress:
             posts = tqdm(posts)
         for p in posts:
+            if self.get_migrated_id(KIND_POST, p["id"]) is not None:
+                continue
             print(p["name"])
-            r = IntercomAPI.api_create_article(
-                title=p["name"],
-                body=p["body"]["body"],
-                author_id=intercom_admins_id_lookup.get(
-                    p["user_name"],
-                    intercom_admins_id_lookup[self.DEFAULT_INTERCOM_AUTHOR],
-                ),
-                state="published",
-                parent_id=self.df_collections_lookup.loc[
-                    p["space_name"], "intercom_id"
-                ],
-                render=False,
-            )
+            try:
+                article = self.build_article(p, intercom_admins_id_lookup)
+            except ValueError as e:
+                print(e)
+                continue
+            r = IntercomAPI.api_create_article(**article)
+            if isinstance(r, dict):
+                self.record_migrated_post(p, r["id"], article)
             res.append(r)
         return res
+
+    def migrate_all_articles_concurrently(
+        self,
+        posts=None,
+        max_workers: int = 8,
+        rate_per_minute: float = INTERCOM_RATE_PER_MINUTE,
+        display_progress=False,
+    ):
+        """Creates the Intercom articles with up to max_workers calls at once,
+        paced by a token bucket at rate_per_minute.
+        Returns one result per post, in the same order as posts:
+        {"circle_id", "name", "intercom_id", "status", "latency"}
+        """
+        intercom_admins_id_lookup = self.get_intercom_admins_id_lookup()
+        if posts is None:
+            posts = CircleAPI.api_get_posts(render=False)
+        bucket = TokenBucket(rate_per_minute)
+
+        def migrate_post(p):
+            result = {"circle_id": p["id"], "name": p["name"], "intercom_id": None}
+            migrated_id = self.get_migrated_id(KIND_POST, p["id"])
+            if migrated_id is not None:
+                return result | {
+                    "intercom_id": migrated_id,
+                    "status": "skipped",
+                    "latency": 0.0,
+                }
+
+            bucket.acquire()
+            start = time.perf_counter()
+            try:
+                article = self.build_article(p, intercom_admins_id_lookup)
+                r = IntercomAPI.api_create_article(**article)
+                if isinstance(r, dict):
+                    result["intercom_id"] = r["id"]
+                    result["status"] = 200
+                    self.record_migrated_post(p, r["id"], article)
+                else:
+                    result["status"] = r.status_code
+            except Exception as e:
+                result["status"] = f"error: {e}"
+            result["latency"] = time.perf_counter() - start
+            return result
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            res = executor.map(migrate_post, posts)
+            if display_progress:
+                res = tqdm(res, total=len(posts))
+            res = list(res)
+        duration = max(time.perf_counter() - start, 1e-9)
+
+        nb_created = sum(r["status"] == 200 for r in res)
+        print(
+            f"{nb_created}/{len(res)} articles created in {duration:.1f}s"
+            f" ({len(res) / duration:.1f} posts/s)"
+        )
+        return res
+
+    def sync_articles(
+        self, posts=None, delete_missing=False, dry_run=False, are_you_sure=False
+    ):
+        """Pushes to Intercom only the Circle posts that changed since the last
+        migration / sync recorded in the journal:
+        - new posts are created
+        - posts whose updated_at and content hash changed are updated
+        - with delete_missing, articles of posts deleted on Circle are deleted;
+          this needs the full listing of the posts (posts=None) and, unless
+          dry_run, are_you_sure=True
+        The space groups / spaces are read again (not from the cache), and their
+        missing collections are created first. Posts whose space still has no
+        collection (e.g. with dry_run, a space created since) are in "errors".
+        With dry_run=True, nothing is sent: only the planned actions are returned.
+        Returns {"created": [...], "updated": [...], "deleted": [...],
+        "unchanged": [...], "errors": [...]} (Circle post ids); the posts whose
+        API call failed are in "errors" and stay as they were in the journal.
+        """
+        if self.journal is None:
+            raise ValueError("sync_articles needs a journal")
+        if delete_missing and posts is not None:
+            raise ValueError(
+                "delete_missing needs all the posts: don't pass a subset of posts"
+            )
+        if delete_missing and not dry_run and not are_you_sure:
+            raise ValueError('You have to set "are_you_sure" to True')
+        ## the latest spaces, with a collection for each
+        self.load_collections(use_cache=False)
+        if not dry_run:
+            self.migrate_all_collections()
+        intercom_admins_id_lookup = self.get_intercom_admins_id_lookup()
+        if posts is None:
+            ## a sync must see the latest posts, not a cached listing
+            posts = CircleAPI.api_get_posts(render=False, use_cache=False)
+        states = self.journal.get_states(KIND_POST)
+
+        actions = {
+            "created": [],
+            "updated": [],
+            "deleted": [],
+            "unchanged": [],
+            "errors": [],
+        }
+        for p in posts:
+            circle_id = str(p["id"])
+            state = states.get(circle_id)
+            try:
+                article = self.build_article(p, intercom_admins_id_lookup)
+            except ValueError as e:
+                print(e)
+                actions["errors"].append(p["id"])
+                continue
+            if state is None:
+                action = "created"
+            elif state["circle_updated_at"] == p.get("updated_at") and (
+                state["content_hash"] is not None
+            ):
+                action = "unchanged"
+            elif state["content_hash"] == self.hash_article(article):
+                ## touched on Circle but nothing Intercom shows changed
+                action = "unchanged"
+                if not dry_run:
+                    self.record_migrated_post(p, state["intercom_id"], article)
+            else:
+                action = "updated"
+            if dry_run or action == "unchanged":
+                actions[action].append(p["id"])
+                continue
+
+            if action == "created":
+                r = IntercomAPI.api_create_article(**article)
+            else:
+                r = IntercomAPI.api_update_article(state["intercom_id"], **article)
+            if isinstance(r, dict):
+                self.record_migrated_post(p, r["id"], article)
+                actions[action].append(p["id"])
+            else:
+                actions["errors"].append(p["id"])
+
+        if delete_missing:
+            posts_id = {str(p["id"]) for p in posts}
+            for circle_id, state in states.items():
+                if circle_id in posts_id:
+                    continue
+                if dry_run:
+                    actions["deleted"].append(circle_id)
+                    continue
+                url = f"{IntercomAPI.INTERCOM_ARTICLES}/{state['intercom_id']}"
+                ## 404: the article was already deleted on Intercom
+                if IntercomAPI.api_delete(url) in [200, 404]:
+                    self.journal.delete(KIND_POST, circle_id)
+                    actions["deleted"].append(circle_id)
+                else:
+                    actions["errors"].append(circle_id)
+
+        print(", ".join(f"{len(v)} {k}" for (k, v) in actions.items()))
+        return actions
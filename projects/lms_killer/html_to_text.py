@@ -1,8 +1,55 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Iterable, Optional
+
 import html2text
+import pandas as pd
 
+## below this number of bodies, starting the processes costs more than it saves
+BATCH_MIN_SIZE_FOR_POOL = 200
 
-def convert_html_to_text(body_html: str, include_links: bool = True) -> str:
+
+def build_text_maker(include_links: bool = True) -> html2text.HTML2Text:
     text_maker = html2text.HTML2Text()
     text_maker.ignore_links = not include_links
+    return text_maker
+
+
+def convert_html_to_text(body_html: str, include_links: bool = True) -> str:
+    ## a new parser per body: one left in the middle of an unclosed tag
+    ## changes the output of the next body (and building one is cheap)
+    text_maker = build_text_maker(include_links)
     body_md = text_maker.handle(body_html)
     return body_md
+
+
+def convert_html_to_text_batch(
+    bodies_html: Iterable[str],
+    include_links: bool = True,
+    max_workers: Optional[int] = None,
+    chunksize: Optional[int] = None,
+) -> list[str] | pd.Series:
+    """convert_html_to_text on many bodies, spread over max_workers processes
+    (default: one per core) in chunks of chunksize bodies.
+    Keeps the order; a Series gives a Series with the same index.
+    """
+    index = bodies_html.index if isinstance(bodies_html, pd.Series) else None
+    bodies_html = list(bodies_html)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    convert = partial(convert_html_to_text, include_links=include_links)
+
+    if max_workers == 1 or len(bodies_html) < BATCH_MIN_SIZE_FOR_POOL:
+        bodies_md = [convert(b) for b in bodies_html]
+    else:
+        if chunksize is None:
+            ## a few chunks per process, to even out the bodies of different sizes
+            chunksize = max(1, math.ceil(len(bodies_html) / (max_workers * 4)))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            bodies_md = list(executor.map(convert, bodies_html, chunksize=chunksize))
+
+    if index is not None:
+        return pd.Series(bodies_md, index=index)
+    return bodies_md